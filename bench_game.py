@@ -0,0 +1,461 @@
+'''
+Network-free benchmark of the Game state machine.
+
+Game is driven with register/button/unregister events on an event loop with
+a virtual clock, so the control tasks' sleeps are skipped instead of waited
+for. Units are replaced by sinks that encode the commands they are given but
+never touch a socket.
+
+The events come either from a synthetic player or from a recorded trace
+(JSON lines of {"t": seconds, "event": type, "unit": id, "value": ...}, the
+value being the features of a REGISTER or the distance of a DISTANCE_UPDATE).
+The trace of a synthetic run can be saved with --record and replayed later
+with --trace and the same --seed.
+
+    python bench_game.py -n 50 --rounds 200
+    python bench_game.py -n 50 --rounds 200 --allocations
+'''
+
+import argparse
+import asyncio
+from collections import defaultdict
+import json
+import random
+import selectors
+import sys
+import time
+import tracemalloc
+from typing import Any, Iterable, Optional
+
+import gamemaster
+from gamemaster import DEFAULT_ROOM, Game, Rooms, Unit
+import order
+
+# Virtual seconds between two synthetic events
+STEP = 0.2
+
+
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+    ''' Event loop whose clock only moves when advance() is called '''
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._now = 0.0
+
+    def time(self) -> float:
+        return self._now
+
+    def advance(self, seconds: float):
+        self._now += seconds
+
+
+class _ScaledSelector:
+    def __init__(self, selector: selectors.BaseSelector, speed: float) -> None:
+        self._selector = selector
+        self._speed = speed
+
+    def select(self, timeout: Optional[float] = None):
+        return self._selector.select(None if timeout is None else timeout / self._speed)
+
+    def __getattr__(self, name: str):
+        return getattr(self._selector, name)
+
+
+class ScaledTimeLoop(asyncio.SelectorEventLoop):
+    ''' Event loop whose clock runs speed times faster than real time '''
+
+    def __init__(self, speed: float) -> None:
+        super().__init__(_ScaledSelector(selectors.DefaultSelector(), speed))
+        self.speed = speed
+        self._start = time.monotonic()
+
+    def time(self) -> float:
+        return (time.monotonic() - self._start) * self.speed
+
+
+class SinkSocket:
+    latency = 0.0
+    closed = False
+
+
+class SinkUnit(Unit):
+    ''' A Unit that encodes its commands and drops them '''
+
+    def __init__(self, unit_id: int, features: Iterable[str] = ()) -> None:
+        super().__init__(SinkSocket(), unit_id, features)
+        # Nothing to drain the mailbox or answer pings, the sink never stalls
+        self._send_task.cancel()
+        self._probe_task.cancel()
+        self.latency.add_sample(0.01)
+
+        self.frames = 0
+
+    def send(self, data: dict[str, Any]):
+        gamemaster.protocol.encode(data, self.binary)
+        self.frames += 1
+
+    def send_frames(self, frames: list[tuple[str, bytes]]):
+        self.frames += len(frames)
+
+
+class Stats:
+    def __init__(self) -> None:
+        self.count = 0
+        self.elapsed_ns = 0
+        self.peak_bytes = 0
+        self.blocks = 0
+
+    def __repr__(self) -> str:
+        per_event = self.elapsed_ns / max(self.count, 1)
+        line = f"{self.count:8d} events {per_event / 1000:9.2f}us/event " \
+            f"{1e9 / max(per_event, 1):10.0f} events/s"
+        if self.peak_bytes:
+            line += f" {self.peak_bytes / self.count:9.0f} B/event" \
+                f" {self.blocks / self.count:7.1f} blocks/event"
+        return line
+
+
+class Harness:
+    def __init__(self, loop: asyncio.SelectorEventLoop, features: list[str], allocations: bool) -> None:
+        self.loop = loop
+        self.features = features
+        self.allocations = allocations
+
+        self.rooms = Rooms()
+        self.units: dict[int, SinkUnit] = {}
+        self.unit_rooms: dict[int, str] = {}
+        self.frames = 0
+
+        self.trace: list[dict[str, Any]] = []
+        self.stats: dict[tuple[str, str], Stats] = defaultdict(Stats)
+
+    async def settle(self):
+        ''' Lets the control tasks run until they block on a timer '''
+        for _ in range(4):
+            await asyncio.sleep(0)
+
+    async def advance_to(self, t: float):
+        if not isinstance(self.loop, VirtualTimeLoop):
+            if t > self.loop.time():
+                await asyncio.sleep(t - self.loop.time())
+            return
+
+        while self.loop.time() < t:
+            # Step through the due timers one by one so they fire in order
+            timers = [handle.when() for handle in self.loop._scheduled
+                      if not handle.cancelled() and handle.when() > self.loop.time()]
+            next_timer = min(timers, default=t)
+            self.loop.advance(min(next_timer, t) - self.loop.time())
+            await self.settle()
+
+    def _apply(self, event: str, unit_id: int, value: Any, room: str):
+        if event == 'REGISTER':
+            features = self.features if value is None else value
+            unit = self.units[unit_id] = SinkUnit(unit_id, features)
+            self.unit_rooms[unit_id] = room
+            self.rooms.join(room).register(unit_id, unit)
+            return
+
+        game = self.rooms.games.get(self.unit_rooms.get(unit_id, room))
+        if game is None:
+            return
+
+        if event == 'DISTANCE_UPDATE':
+            game.update_unit_distance(unit_id, value)
+        elif event == 'BUTTON_PRESSED':
+            game.button_pressed(unit_id)
+        elif event == 'BUTTON_RELEASED':
+            game.button_released(unit_id)
+        elif event == 'UNREGISTER':
+            self.rooms.leave(self.unit_rooms.pop(unit_id, room), unit_id)
+            unit = self.units.pop(unit_id, None)
+            if unit is not None:
+                self.frames += unit.frames
+
+    async def dispatch(self, t: float, event: str, unit_id: int, value: Any = None,
+                       room: Optional[str] = None):
+        await self.advance_to(t)
+
+        step = {'t': t, 'event': event, 'unit': unit_id}
+        if value is not None:
+            step['value'] = value
+        if room is not None:
+            step['room'] = room
+        self.trace.append(step)
+
+        if room is None:
+            room = self.unit_rooms.get(unit_id, DEFAULT_ROOM)
+        game = self.rooms.games.get(room)
+        state = game.state if game is not None else Game.STATES.NoUnits
+
+        stats = self.stats[(state.name, event)]
+        if self.allocations:
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            blocks = sys.getallocatedblocks()
+
+        start = time.perf_counter_ns()
+        self._apply(event, unit_id, value, room)
+        await self.settle()
+        stats.elapsed_ns += time.perf_counter_ns() - start
+
+        if self.allocations:
+            _, peak = tracemalloc.get_traced_memory()
+            stats.peak_bytes += peak - before
+            stats.blocks += max(sys.getallocatedblocks() - blocks, 0)
+        stats.count += 1
+
+    async def shutdown(self):
+        for unit_id in list(self.units):
+            await self.dispatch(self.loop.time(), 'UNREGISTER', unit_id)
+
+
+async def play_round(harness: Harness, game: Game, player: random.Random,
+                     mistake: float, t: float) -> float:
+    # Wait out Lose/Win and the pre-game timers
+    while game.state not in (Game.STATES.PreGameMultiple, Game.STATES.PreGameSingle):
+        t += STEP * 10
+        await harness.advance_to(t)
+
+    held: list[int] = []
+    while game.state != Game.STATES.Lose and game.state != Game.STATES.Win:
+        if game.state in (Game.STATES.Playing, Game.STATES.PlayingAllReleased) and \
+                game.wrong is not None and player.random() < mistake:
+            target = game.wrong
+        elif game.correct is not None:
+            target = game.correct
+        else:
+            break
+
+        t += STEP
+        await harness.dispatch(t, 'BUTTON_PRESSED', target)
+        held.append(target)
+
+        # Players keep at most a couple of buttons down and now and
+        # then let go of all of them
+        if len(held) > 2:
+            t += STEP
+            await harness.dispatch(t, 'BUTTON_RELEASED', held.pop(0))
+        elif player.random() < 0.2:
+            while held:
+                t += STEP
+                await harness.dispatch(t, 'BUTTON_RELEASED', held.pop(0))
+
+    for unit_id in held:
+        t += STEP
+        await harness.dispatch(t, 'BUTTON_RELEASED', unit_id)
+
+    return t
+
+
+async def play_synthetic(harness: Harness, units: int, rounds: int, mistake: float,
+                         seed: int, rooms: int = 1):
+    ''' A player per room that mostly presses the right buttons '''
+    # The player has its own generator so a replay sees the same Game randomness
+    player = random.Random(seed)
+
+    t = 0.0
+    for unit_id in range(1, units * rooms + 1):
+        t += 0.01
+        room = DEFAULT_ROOM if rooms == 1 else f"room{unit_id % rooms}"
+        await harness.dispatch(t, 'REGISTER', unit_id, room=room)
+
+    for _ in range(rounds):
+        for game in list(harness.rooms.games.values()):
+            t = await play_round(harness, game, player, mistake, t)
+
+    await harness.shutdown()
+
+
+async def play_trace(harness: Harness, trace: list[dict[str, Any]]):
+    for step in trace:
+        await harness.dispatch(step['t'], step['event'], step['unit'],
+                               step.get('value'), step.get('room'))
+
+
+def report(harness: Harness, wall: float):
+    total = Stats()
+    for (state, event), stats in sorted(harness.stats.items()):
+        print(f"{state:>20s} {event:<16s} {stats}")
+        total.count += stats.count
+        total.elapsed_ns += stats.elapsed_ns
+        total.peak_bytes += stats.peak_bytes
+        total.blocks += stats.blocks
+
+    print(f"{'total':>37s} {total}")
+    frames = harness.frames + sum(unit.frames for unit in harness.units.values())
+    print(f"wall time {wall:.2f}s, {frames} frames sent to units")
+
+
+def parse_arguments(args: list[str]):
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-n', '--units', type=int, default=20,
+                        help='Units per room')
+    parser.add_argument('--rooms', type=int, default=1)
+    parser.add_argument('--rounds', type=int, default=100)
+    parser.add_argument('--mistake', type=float, default=0.05,
+                        help='Probability of pressing the wrong unit')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true',
+                        help='Units do not advertise any protocol features')
+    parser.add_argument('--allocations', action='store_true',
+                        help='Trace allocations with tracemalloc, slows the run down')
+    parser.add_argument('--trace', metavar='path',
+                        help='Replay a recorded trace instead of the synthetic player')
+    parser.add_argument('--record', metavar='path',
+                        help='Write the events that were played to a trace')
+    parser.add_argument('--order', choices=sorted(order.STRATEGIES), default=Game.ORDER_STRATEGY)
+    parser.add_argument('--order-bench', action='store_true',
+                        help='Check that distances reach the order strategies and compare the '
+                        'order engine with plain lists at thousands of units')
+    parser.add_argument('--scaling', action='store_true',
+                        help='Run the synthetic player over a grid of rooms x units per room')
+
+    return parser.parse_args(args)
+
+
+async def run(options, loop: VirtualTimeLoop) -> Harness:
+    random.seed(options.seed)
+    gamemaster._logger.disabled = True
+    Game.ORDER_STRATEGY = options.order
+
+    features = [] if options.json else gamemaster.protocol.FEATURES
+    harness = Harness(loop, features, options.allocations)
+
+    if options.trace:
+        with open(options.trace) as trace:
+            await play_trace(harness, [json.loads(line) for line in trace if line.strip()])
+    else:
+        await play_synthetic(harness, options.units, options.rounds,
+                             options.mistake, options.seed, options.rooms)
+
+    return harness
+
+
+SCALING_ROOMS = (1, 2, 4, 8, 16)
+SCALING_UNITS = (10, 50, 200)
+
+
+def scaling(options):
+    print(f"{'rooms':>6s} {'units/room':>10s} {'events':>8s} {'us/event':>10s} {'events/s':>10s}")
+    for rooms in SCALING_ROOMS:
+        for units in SCALING_UNITS:
+            options.rooms = rooms
+            options.units = units
+
+            loop = VirtualTimeLoop()
+            asyncio.set_event_loop(loop)
+            harness = loop.run_until_complete(run(options, loop))
+            loop.close()
+
+            count = sum(stats.count for stats in harness.stats.values())
+            elapsed = sum(stats.elapsed_ns for stats in harness.stats.values())
+            per_event = elapsed / max(count, 1)
+            print(f"{rooms:6d} {units:10d} {count:8d} {per_event / 1000:10.2f} {1e9 / per_event:10.0f}")
+
+
+ORDER_SIZES = (1000, 5000, 20000)
+
+
+def order_benchmark():
+    ''' A round's worth of next, random wrong and leave operations per unit '''
+    def with_list(unit_ids: list[int]):
+        upcoming = list(unit_ids)
+        while upcoming:
+            upcoming.pop(0)
+            if upcoming:
+                random.choice(upcoming)
+                if len(upcoming) % 4 == 0:
+                    upcoming.remove(upcoming[len(upcoming) // 2])
+
+    def with_order(unit_ids: list[int]):
+        upcoming = order.Order(unit_ids)
+        while upcoming:
+            upcoming.popleft()
+            if upcoming:
+                wrong = upcoming.choice()
+                if len(upcoming) % 4 == 0:
+                    upcoming.discard(wrong)
+
+    print(f"{'units':>6s} {'list us/unit':>13s} {'Order us/unit':>14s}")
+    for size in ORDER_SIZES:
+        unit_ids = list(range(size))
+        random.shuffle(unit_ids)
+
+        timings = []
+        for play in (with_list, with_order):
+            start = time.perf_counter_ns()
+            play(unit_ids)
+            timings.append((time.perf_counter_ns() - start) / size / 1000)
+        print(f"{size:6d} {timings[0]:13.2f} {timings[1]:14.2f}")
+
+
+def distance_check(units: int = 8):
+    ''' Fails unless the distances the units report reach the sequencing strategy '''
+    loop = VirtualTimeLoop()
+    asyncio.set_event_loop(loop)
+    gamemaster._logger.disabled = True
+    harness = Harness(loop, [], False)
+
+    async def setup() -> list[int]:
+        for unit_id in range(1, units + 1):
+            await harness.dispatch(unit_id * STEP, 'REGISTER', unit_id)
+            await harness.dispatch(unit_id * STEP, 'DISTANCE_UPDATE', unit_id, float(unit_id))
+
+        game = harness.rooms.games[DEFAULT_ROOM]
+        strategy, Game.ORDER_STRATEGY = Game.ORDER_STRATEGY, 'far_first'
+        try:
+            game._setup_game()
+        finally:
+            Game.ORDER_STRATEGY = strategy
+        distances = {unit.distance for unit in game.ACTIVE.values()}
+        unit_list = list(game.unit_list)
+        await harness.shutdown()
+
+        if len(distances) < 2:
+            sys.exit("Every unit has the same distance, the distance-aware orders are arbitrary")
+        return unit_list
+
+    unit_list = loop.run_until_complete(setup())
+    loop.close()
+
+    if unit_list != list(range(units, 0, -1)):
+        sys.exit(f"far_first ignored the reported distances: {unit_list}")
+    print(f"far_first order of {units} units follows their distances")
+
+
+def main(args: list[str]):
+    options = parse_arguments(args)
+
+    if options.order_bench:
+        distance_check()
+        order_benchmark()
+        return
+
+    if options.scaling:
+        scaling(options)
+        return
+
+    loop = VirtualTimeLoop()
+    asyncio.set_event_loop(loop)
+
+    if options.allocations:
+        tracemalloc.start()
+
+    start = time.perf_counter()
+    harness = loop.run_until_complete(run(options, loop))
+    wall = time.perf_counter() - start
+
+    report(harness, wall)
+
+    if options.record:
+        with open(options.record, 'w') as trace:
+            for step in harness.trace:
+                trace.write(json.dumps(step) + '\n')
+
+    loop.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
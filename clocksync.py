@@ -0,0 +1,116 @@
+'''
+NTP-style estimation of the offset between a unit's clock and the
+gamemaster's clock, so that the 'at' field of a command can be honoured.
+
+Every exchange produces the four classic timestamps: t0 unit send, t1
+gamemaster receive, t2 gamemaster send and t3 unit receive.
+'''
+
+import asyncio
+from collections import deque
+import json
+import time
+from typing import Optional, Union
+
+from websockets.exceptions import ConnectionClosed
+
+import protocol
+
+# Longest a command is held back, guards against a bogus 'at'
+MAX_SCHEDULE_AHEAD = 2.0
+
+# Drift beyond this is treated as a measurement error, crystals are ~50ppm
+MAX_DRIFT = 500e-6
+
+# A quick burst right after connecting, then a slow refresh
+SYNC_BURST = 8
+SYNC_BURST_INTERVAL = 0.2
+SYNC_INTERVAL = 5
+
+
+class ClockEstimator:
+    def __init__(self, window: int = 32) -> None:
+        # (local time, offset, round trip delay)
+        self.samples: deque[tuple[float, float, float]] = deque(maxlen=window)
+        self.drift = 0.0
+
+    @property
+    def synchronized(self) -> bool:
+        return bool(self.samples)
+
+    def reset(self):
+        self.samples.clear()
+        self.drift = 0.0
+
+    def add_sample(self, t0: float, t1: float, t2: float, t3: float):
+        offset = ((t1 - t0) + (t2 - t3)) / 2
+        delay = (t3 - t0) - (t2 - t1)
+
+        self.samples.append(((t0 + t3) / 2, offset, max(delay, 0.0)))
+        self._update_drift()
+
+    def _best(self) -> tuple[float, float, float]:
+        # The exchange with the shortest round trip has the least asymmetry
+        return min(self.samples, key=lambda sample: sample[2])
+
+    def _update_drift(self):
+        if len(self.samples) < 4:
+            return
+
+        # Fit over the faster half of the samples, queueing delay is noise
+        samples = sorted(self.samples, key=lambda sample: sample[2])
+        samples = samples[:max(len(samples) // 2, 2)]
+
+        mean_t = sum(sample[0] for sample in samples) / len(samples)
+        mean_offset = sum(sample[1] for sample in samples) / len(samples)
+        variance = sum((sample[0] - mean_t) ** 2 for sample in samples)
+        if variance == 0:
+            return
+
+        covariance = sum((sample[0] - mean_t) * (sample[1] - mean_offset)
+                         for sample in samples)
+        self.drift = max(-MAX_DRIFT, min(MAX_DRIFT, covariance / variance))
+
+    def offset(self, now: Optional[float] = None) -> float:
+        ''' Gamemaster clock minus local clock '''
+        if not self.samples:
+            return 0.0
+
+        if now is None:
+            now = time.time()
+
+        local, offset, _ = self._best()
+        return offset + self.drift * (now - local)
+
+    def to_local(self, server_time: float) -> float:
+        return server_time - self.offset(server_time)
+
+
+async def wait_until(clock: ClockEstimator, at: Union[int, str, None]):
+    ''' Sleeps until the gamemaster time 'at' on the local clock '''
+    if at is None:
+        return
+
+    delay = clock.to_local(protocol.at_to_epoch(at)) - time.time()
+    if delay > 0:
+        await asyncio.sleep(min(delay, MAX_SCHEDULE_AHEAD))
+
+
+async def synchronize(socket, clock: ClockEstimator):
+    ''' Sends CLOCK_PING forever, the CLOCK_PONG answers go to on_pong '''
+    clock.reset()
+
+    sent = 0
+    try:
+        while True:
+            await socket.send(json.dumps(
+                {'type': 'CLOCK_PING', 't0': time.time()}).encode())
+            sent += 1
+
+            await asyncio.sleep(SYNC_BURST_INTERVAL if sent < SYNC_BURST else SYNC_INTERVAL)
+    except ConnectionClosed:
+        pass
+
+
+def on_pong(clock: ClockEstimator, message: dict, received: float):
+    clock.add_sample(message['t0'], message['t1'], message['t2'], received)
@@ -0,0 +1,75 @@
+'''
+Fixed-timestep compositor for the outputs of a unit.
+
+One loop ticks at FRAME_RATE against absolute deadlines, so the time spent
+rendering does not add up into drift, and renders every layer on the same
+tick. Animations are timed in ticks rather than by their own sleeps, which
+keeps the button LED, the matrix and the sound in phase.
+
+A tick that starts more than half an interval after its deadline is late,
+whole intervals that passed without a tick are dropped and skipped instead
+of rendered in a burst.
+'''
+
+import asyncio
+from typing import Optional
+
+FRAME_RATE = 50
+REPORT_INTERVAL = 10.0
+
+
+class Layer:
+    def render(self, tick: int):
+        raise NotImplementedError(
+            "You have to override this function in the derivative")
+
+
+class Compositor:
+    def __init__(self, frame_rate: float = FRAME_RATE) -> None:
+        self.interval = 1 / frame_rate
+        self.layers: list[Layer] = []
+        self.tick = 0
+
+        self.frames = 0
+        self.late = 0
+        self.dropped = 0
+
+    def add(self, layer: Layer):
+        self.layers.append(layer)
+
+    def remove(self, layer: Layer):
+        if layer in self.layers:
+            self.layers.remove(layer)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        while True:
+            deadline = start + (self.tick + 1) * self.interval
+            delay = deadline - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            lateness = loop.time() - deadline
+            if lateness >= self.interval:
+                missed = int(lateness / self.interval)
+                self.dropped += missed
+                self.tick += missed
+            if lateness > self.interval / 2:
+                self.late += 1
+
+            self.tick += 1
+            for layer in list(self.layers):
+                try:
+                    layer.render(self.tick)
+                except Exception as e:
+                    print("Layer", layer, "failed to render:", repr(e))
+            self.frames += 1
+
+    async def report(self, interval: float = REPORT_INTERVAL):
+        reported: Optional[tuple[int, int]] = None
+        while True:
+            await asyncio.sleep(interval)
+            if (self.late, self.dropped) != reported:
+                reported = (self.late, self.dropped)
+                print(f"Compositor: {self.frames} frames, {self.late} late, {self.dropped} dropped")
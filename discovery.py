@@ -0,0 +1,125 @@
+'''
+Gamemaster discovery for the units.
+
+Every known node is asked for /alive at the same time. A node that answers
+302 is the gamemaster itself and ends the search right away, the other nodes
+only name the gamemaster they know of, which is used when nobody claims the
+role. The last gamemaster found is kept on disk and asked first on boot.
+
+Units skip discovery when a gamemaster is cached and open the /units
+websocket right away, a node that is no longer the gamemaster redirects
+them, so discovery and attaching share one TLS connection.
+'''
+
+import asyncio
+import http
+import os
+import random
+import ssl
+from typing import Optional
+
+PROBE_TIMEOUT = 1.0
+# Head start of the cached gamemaster before every node is asked
+CACHED_TIMEOUT = 0.3
+# Opening the /units websocket, shorter for a cached gamemaster that may be gone
+CONNECT_TIMEOUT = 10.0
+CACHED_CONNECT_TIMEOUT = PROBE_TIMEOUT
+
+DEFAULT_CACHE = os.path.expanduser('~/.cache/norrkoping/gamemaster')
+
+
+async def probe(url: str, ssl_context: ssl.SSLContext,
+                timeout: float = PROBE_TIMEOUT) -> Optional[tuple[int, str]]:
+    ''' Status and body of GET /alive, None if the node did not answer '''
+    async def get() -> tuple[int, str]:
+        reader, writer = await asyncio.open_connection(url, 8002, ssl=ssl_context)
+        try:
+            writer.write(f"GET /alive HTTP/1.1\r\nHost: {url}\r\nConnection: close\r\n\r\n".encode())
+            response = await reader.read()
+        finally:
+            writer.close()
+
+        head, _, body = response.partition(b'\r\n\r\n')
+        status = int(head.split(b' ', 2)[1])
+        return status, body.decode().strip()
+
+    try:
+        return await asyncio.wait_for(get(), timeout)
+    except (OSError, asyncio.TimeoutError, ValueError, IndexError):
+        return None
+
+
+def load_cached(cache_path: Optional[str]) -> Optional[str]:
+    if cache_path is None:
+        return None
+    try:
+        with open(cache_path) as cache:
+            return cache.read().strip() or None
+    except OSError:
+        return None
+
+
+def forget_cached(cache_path: Optional[str]):
+    if cache_path is None:
+        return
+    try:
+        os.remove(cache_path)
+    except OSError:
+        pass
+
+
+def store_cached(cache_path: Optional[str], gamemaster: str):
+    if cache_path is None or load_cached(cache_path) == gamemaster:
+        return
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(cache_path, 'w') as cache:
+            cache.write(f"{gamemaster}\n")
+    except OSError:
+        pass
+
+
+async def discover(gamemaster_urls: list[str], ssl_context: ssl.SSLContext,
+                   cache_path: Optional[str] = DEFAULT_CACHE) -> Optional[str]:
+    cached = load_cached(cache_path)
+    if cached is not None:
+        response = await probe(cached, ssl_context, CACHED_TIMEOUT)
+        if response is not None and response[0] == http.HTTPStatus.FOUND:
+            return response[1]
+
+    hint = None
+    probes = [asyncio.create_task(probe(url, ssl_context)) for url in gamemaster_urls]
+    try:
+        for next_response in asyncio.as_completed(probes):
+            response = await next_response
+            if response is None:
+                continue
+
+            status, body = response
+            if status == http.HTTPStatus.FOUND:
+                store_cached(cache_path, body)
+                return body
+            elif body and hint is None:
+                hint = body
+    finally:
+        for task in probes:
+            task.cancel()
+
+    return hint
+
+
+class Backoff:
+    ''' Exponential backoff with full jitter, so units do not retry in lockstep '''
+
+    def __init__(self, base: float = 0.25, cap: float = 10.0) -> None:
+        self.base = base
+        self.cap = cap
+        self.attempt = 0
+
+    def next(self) -> float:
+        delay = random.uniform(0, min(self.cap, self.base * 2 ** self.attempt))
+        self.attempt = min(self.attempt + 1, 32)
+        return delay
+
+    def reset(self):
+        self.attempt = 0
@@ -0,0 +1,93 @@
+'''
+Framebuffer for the LED matrix.
+
+Frames are drawn into an array of packed 24-bit colors, the layout
+rpi_ws281x keeps, and copied to the strip in one pass right before show().
+Whole-frame operations run in C on the array, so a frame costs one packed
+int per pixel instead of a color conversion and a call per pixel.
+'''
+
+from array import array
+from typing import Callable
+
+try:
+    from rpi_ws281x import ws as _ws
+except ImportError:
+    _ws = None
+
+RGB = tuple[int, int, int]
+
+
+def pack(r: int, g: int, b: int) -> int:
+    ''' Same layout as rpi_ws281x.Color '''
+    return (r << 16) | (g << 8) | b
+
+
+def unpack(color: int) -> RGB:
+    return (color >> 16) & 0xFF, (color >> 8) & 0xFF, color & 0xFF
+
+
+def write(strip, pixels: array):
+    ''' Copies packed colors to the strip, they are lit on the next show() '''
+    channel = getattr(strip, '_channel', None)
+    if _ws is not None and channel is not None:
+        # What setPixelColor ends up calling, without two Python frames per pixel
+        led_set = _ws.ws2811_led_set
+        for index, color in enumerate(pixels):
+            led_set(channel, index, color)
+    else:
+        set_pixel = strip.setPixelColor
+        for index, color in enumerate(pixels):
+            set_pixel(index, color)
+
+
+class FrameBuffer:
+    def __init__(self, length: int) -> None:
+        self.pixels = array('I', [0]) * length
+
+    def __len__(self) -> int:
+        return len(self.pixels)
+
+    def __getitem__(self, index: int) -> RGB:
+        return unpack(self.pixels[index])
+
+    def __setitem__(self, index: int, rgb: RGB):
+        self.pixels[index] = pack(*rgb)
+
+    def fill(self, rgb: RGB):
+        self.pixels[:] = array('I', [pack(*rgb)]) * len(self.pixels)
+
+    def clear(self):
+        self.fill((0, 0, 0))
+
+    def gradient(self, start: RGB, end: RGB):
+        ''' Linear blend from the first to the last pixel '''
+        steps = max(len(self.pixels) - 1, 1)
+        self.pixels[:] = array('I', (
+            pack(*(a + (b - a) * i // steps for a, b in zip(start, end)))
+            for i in range(len(self.pixels))))
+
+    def frame(self, pixels: array):
+        ''' Copies a prepared frame of packed colors '''
+        self.pixels[:] = pixels
+
+    def scale(self, brightness: float):
+        ''' Dims every pixel, brightness between 0 and 1 '''
+        level = round(brightness * 256)
+        self.pixels[:] = array('I', (
+            pack(((color >> 16) & 0xFF) * level >> 8, ((color >> 8) & 0xFF) * level >> 8,
+                 (color & 0xFF) * level >> 8)
+            for color in self.pixels))
+
+    def rotate(self, steps: int = 1):
+        steps %= len(self.pixels) or 1
+        self.pixels[:] = self.pixels[-steps:] + self.pixels[:-steps]
+
+    def map(self, function: Callable[[int, RGB], RGB]):
+        ''' Replaces every pixel by function(index, rgb) '''
+        for index, color in enumerate(self.pixels):
+            self.pixels[index] = pack(*function(index, unpack(color)))
+
+    def write(self, strip):
+        ''' Copies the frame to the strip, it is lit on the next show() '''
+        write(strip, self.pixels)
@@ -8,68 +8,108 @@ import logging
 import random
 import ssl
 import sys
-from typing import Any, Optional, Union
+import time
+from typing import Any, Callable, Iterable, Optional, Union
 import requests
 
-import aiohttp
-
 from websockets.server import serve
 from websockets.client import connect
-from websockets.exceptions import ConnectionClosedError
+from websockets.exceptions import ConnectionClosedError, WebSocketException
 
 from websockets.server import WebSocketServerProtocol
 
-logging.basicConfig(format='%(asctime)s %(message)s',
-                    filename='game.log', filemode='a', level=logging.INFO)
-_logger = logging.getLogger("gamemaster")
-
-
-class Unit:
-    def __init__(self, ws: WebSocketServerProtocol, unit_id: int) -> None:
-        self.ws = ws
-        self.button_pressed = False
-        self.unit_id = unit_id
-        self.distance = 0.0
-
-        self.queue = asyncio.Queue()
-
-        self._send_task = asyncio.create_task(self._send())
+import journal
+import logpipe
+import metrics
+import order
+import protocol
+import tlssession
+import tracing
+from latency import LatencyTracker, probe
+from outbox import Mailbox
+from replication import Replica, Replicator
 
+_logger = logging.getLogger("gamemaster")
+_journal: journal.Journal = journal.NullJournal()
+
+DEFAULT_ROOM = 'default'
+
+# Heartbeat of the links between gamemasters, a peer that misses a pong for
+# PEER_PING_TIMEOUT is considered failed
+PEER_PING_INTERVAL = 0.1
+PEER_PING_TIMEOUT = 0.3
+PEER_TIMEOUT = 0.5
+# Failed peers are left out of elections for this long instead of waiting
+# for their timeouts again
+PEER_SUSPECT_PERIOD = 2.0
+
+# Everything is served on port 8002
+UNITS_PATH = '/units'
+PEER_PATH = '/peer'
+REPLICATE_PATH = '/replicate'
+METRICS_PATH = '/metrics'
+
+UNIT_EVENTS = ('REGISTER', 'UNREGISTER', 'BUTTON_PRESSED', 'BUTTON_RELEASED',
+               'DISTANCE_UPDATE', 'CLOCK_PING', 'RENDERED')
+
+_events = metrics.counter('gamemaster_events_total',
+                          'Messages received from units', ['type'])
+# Resolved once, the handler only does a dict lookup and an add
+_event_counters = {event: _events.labels(event) for event in UNIT_EVENTS}
+_state_dwell = metrics.histogram('gamemaster_state_dwell_seconds',
+                                 'Time a game spent in a state before leaving it', ['state'],
+                                 buckets=(0.1, 0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300))
+_press_to_command = metrics.histogram('gamemaster_press_to_command_seconds',
+                                      'From a button press arriving to its commands written to the unit')
+_trace_hops = metrics.histogram('gamemaster_trace_hop_seconds',
+                                'Time a traced press spent in every hop to the rendered command', ['hop'])
+_hop_histograms = {hop: _trace_hops.labels(hop) for hop in tracing.HOPS}
+_press_to_light = metrics.histogram('gamemaster_press_to_light_seconds',
+                                    'From the button edge to the rendered command on the unit',
+                                    ['channel'])
+# Only the outputs of a unit acknowledge commands, anything else is not made a series
+_channel_press_to_light = {channel: _press_to_light.labels(channel)
+                           for channel in ('BUTTON_LED', 'MATRIX_LED', 'SOUND')}
+_frames_sent = metrics.counter('gamemaster_frames_sent_total',
+                               'Websocket frames written to units')
+_mailbox_coalesced = metrics.counter('gamemaster_mailbox_coalesced_total',
+                                     'Pending commands replaced by a newer one for the same channel')
+_mailbox_dropped = metrics.counter('gamemaster_mailbox_dropped_total',
+                                   'Commands dropped because a unit mailbox was full')
+
+
+class Commands:
     def send(self, data: dict[str, Any]):
-        self.queue.put_nowait(json.dumps(data).encode())
-
-    async def _send(self):
-        while True:
-            message = await self.queue.get()
-            await self.ws.send(message)
+        raise NotImplementedError(
+            "You have to override this function in the derivative")
 
     def start_button_led(self, pattern: Union[str, tuple[int, int, int]], at: datetime):
         self.send({'type': 'BUTTON_LED', 'value': 'START', 'pattern': pattern,
-                  'at': at.strftime("%Y-%m-%d %H:%M:%S.%f")})
+                  'at': at})
 
     def start_matrix(self, pattern: Union[str, tuple[int, int, int]], at: datetime):
         self.send({'type': 'MATRIX_LED', 'value': 'START', 'pattern': pattern,
-                  'at': at.strftime("%Y-%m-%d %H:%M:%S.%f")})
+                  'at': at})
 
     def play_sound(self, filename: str, at: datetime):
         self.send({'type': 'SOUND', 'value': 'START', 'filename': filename,
-                  'at': at.strftime("%Y-%m-%d %H:%M:%S.%f")})
+                  'at': at})
 
     def stop_button_led(self, at: datetime):
         self.send({'type': 'BUTTON_LED', 'value': 'OFF',
-                  'at': at.strftime("%Y-%m-%d %H:%M:%S.%f")})
+                  'at': at})
 
     def stop_matrix(self, at: datetime):
         self.send({'type': 'MATRIX_LED', 'value': 'OFF',
-                  'at': at.strftime("%Y-%m-%d %H:%M:%S.%f")})
+                  'at': at})
 
     def stop_sound(self, at: datetime):
         self.send({'type': 'SOUND', 'value': 'STOP',
-                  'at': at.strftime("%Y-%m-%d %H:%M:%S.%f")})
-        
-    def update_distance(self, distance: float, at:datetime):
-        self.send({'type':'DISTANCE','value':distance,
-                   'at': at.strftime("%Y-%m-%d %H:%M:%S.%f")})
+                  'at': at})
+
+    def update_distance(self, distance: float, at: datetime):
+        self.send({'type': 'DISTANCE', 'value': distance,
+                   'at': at})
 
     def win(self, sound_path: str, at: datetime):
         self.start_button_led("colorscroll", at)
@@ -100,13 +140,153 @@ class Unit:
         self.stop_matrix(at)
         self.stop_sound(at)
 
-    def __del__(self):
+
+class Unit(Commands):
+    def __init__(self, ws: WebSocketServerProtocol, unit_id: int, features: Iterable[str] = ()) -> None:
+        self.ws = ws
+        self.button_pressed = False
+        self.unit_id = unit_id
+        self.distance = 0.0
+
+        self.binary = protocol.FEATURE_BINARY in features
+        self.batch = protocol.FEATURE_BATCH in features
+
+        self.mailbox = Mailbox()
+        self.latency = LatencyTracker()
+        # The press being handled, its commands are tagged with the trace id
+        self.tracing: Optional[tracing.Trace] = None
+        # The press whose commands are pending
+        self.pressed: Optional[tracing.Trace] = None
+        self.traces = tracing.Traces()
+
+        self._send_task = asyncio.create_task(self._send())
+        self._probe_task = asyncio.create_task(probe(ws, self.latency))
+
+    def send(self, data: dict[str, Any]):
+        self.send_frames([(data['type'], protocol.encode(data, self.binary))])
+
+    async def _send(self):
+        while True:
+            # Everything queued while the previous send was in flight,
+            # newest command per channel only
+            frames = await self.mailbox.get()
+            pressed, self.pressed = self.pressed, None
+
+            if len(frames) == 1:
+                await self.ws.send(frames[0])
+                _frames_sent.inc()
+            elif self.batch:
+                await self.ws.send(protocol.encode_batch(frames, self.binary))
+                _frames_sent.inc()
+            else:
+                for frame in frames:
+                    await self.ws.send(frame)
+                _frames_sent.inc(len(frames))
+
+            if pressed is not None:
+                pressed.sent = time.perf_counter()
+                _press_to_command.observe(pressed.sent - pressed.received)
+                self.traces.add(pressed)
+
+    def send_frames(self, frames: list[tuple[str, bytes]]):
+        coalesced = self.mailbox.coalesced
+        trace_id = self.tracing.trace_id if self.tracing is not None else None
+        for channel, frame in frames:
+            if trace_id is not None:
+                frame = protocol.with_trace(frame, trace_id)
+            if self.mailbox.put(channel, frame):
+                _journal.record(journal.Kind.OUTBOUND, self.unit_id, frame)
+            else:
+                _mailbox_dropped.inc()
+                _logger.warning("Unit %#x mailbox full, dropped %s", self.unit_id, channel)
+        if self.mailbox.coalesced != coalesced:
+            _mailbox_coalesced.inc(self.mailbox.coalesced - coalesced)
+
+    async def close(self):
         self._send_task.cancel()
+        self._probe_task.cancel()
+        await asyncio.gather(self._send_task, self._probe_task, return_exceptions=True)
+
+    def rendered(self, ack: dict[str, Any]):
+        ''' Records the hops of a traced press from the acknowledgement of the unit '''
+        # Whatever the unit sent, only known channels and numeric unit hops are taken
+        trace_id, channel, reported = ack.get('trace'), ack.get('channel'), ack.get('hops')
+        if not isinstance(trace_id, int) or channel not in _channel_press_to_light \
+                or not isinstance(reported, dict):
+            return
+
+        trace = self.traces.get(trace_id)
+        if trace is None:
+            return
+
+        checked: dict[str, Any] = {'hops': {hop: float(reported[hop]) for hop in tracing.UNIT_HOPS
+                                            if isinstance(reported.get(hop), (int, float))}}
+        if isinstance(ack.get('elapsed'), (int, float)):
+            checked['elapsed'] = float(ack['elapsed'])
+
+        hops = trace.hops(checked)
+        # The hops up to the unit are shared by every command of the press
+        for hop, duration in hops.items():
+            if hop in tracing.UNIT_HOPS or not trace.acknowledged:
+                _hop_histograms[hop].observe(duration)
+        trace.acknowledged = True
+        if 'elapsed' in checked:
+            _channel_press_to_light[channel].observe(checked['elapsed'])
+
+        _logger.debug("Trace %d of unit %#x rendered %s: %s", trace.trace_id, self.unit_id,
+                      channel, ', '.join(f"{hop} {duration * 1000:.1f}ms"
+                                                for hop, duration in hops.items()),
+                      extra={'event': 'TRACE', 'unit': self.unit_id, 'trace': trace.trace_id,
+                             'channel': channel, 'hops': hops})
 
     def __repr__(self) -> str:
         return hex(self.unit_id)
 
 
+class Effect(Commands):
+    ''' Records commands once so they can be fanned out to many units '''
+
+    def __init__(self) -> None:
+        self.commands: list[dict[str, Any]] = []
+        self._frames: dict[bool, list[tuple[str, bytes]]] = {}
+
+    def send(self, data: dict[str, Any]):
+        self.commands.append(data)
+
+    def frames(self, binary: bool) -> list[tuple[str, bytes]]:
+        ''' (channel, frame) pairs in the encoding of the unit '''
+        if binary not in self._frames:
+            self._frames[binary] = [(command['type'], protocol.encode(command, binary))
+                                    for command in self.commands]
+        return self._frames[binary]
+
+
+class GameSnapshot:
+    ''' Copy of the Game fields, so that formatting can happen later '''
+
+    def __init__(self, game: 'Game') -> None:
+        self.room = game.room
+        self.active = game.ACTIVE.copy().values()
+        self.state = game.state
+        self.correct = game.correct
+        self.unit_list = list(game.unit_list)
+        self.wrong = game.wrong
+        self.previous_correct = set(game.previous_correct)
+        self.pressed_units = set(game.pressed_units)
+
+    def __repr__(self) -> str:
+        return f"""Game:
+            Room:               {self.room}
+            Active:             {self.active}
+            State:              {str(self.state)}
+            Correct:            {self.correct}
+            Upcoming list:      {self.unit_list}
+            Wrong:              {self.wrong}
+            Previous Correct:   {self.previous_correct}
+            Pressed Units:      {self.pressed_units}
+"""
+
+
 class Game:
     STATES = IntEnum(
         'States', ['NoUnits',
@@ -118,17 +298,35 @@ class Game:
                    'Win',
                    'WaitRelease'])
 
-    def __init__(self) -> None:
+    # Effects are scheduled so that this share of commands arrives in time
+    LATENCY_PERCENTILE = 95
+
+    # How long a restored game waits for its units to come back
+    RESUME_GRACE = 3.0
+
+    # Name of the sequencing strategy in order.STRATEGIES
+    ORDER_STRATEGY = 'shuffle'
+
+    def __init__(self, room: str = DEFAULT_ROOM) -> None:
+        self.room = room
         self._state = Game.STATES.NoUnits
+        self._state_since = time.monotonic()
         self.ACTIVE: dict[int, Unit] = {}
 
         self.previous_correct: set[int] = set()
-        self.unit_list: list[int] = []
+        self.unit_list = order.Order()
+        # Keys of ACTIVE, for O(1) random picks
+        self.active_ids = order.IndexedSet()
         self.correct: Optional[int] = None
         self.wrong: Optional[int] = None
 
         self.pressed_units: set[Unit] = set()
 
+        # Units of a restored game that have not registered again yet
+        self.expected: set[int] = set()
+        # Called with the game when its resume ends without any unit back
+        self.abandoned: Optional[Callable[[Game], None]] = None
+
         self._button_pressed_callbacks = {
             Game.STATES.PreGameSingle: self._button_pressed_PreGameSingle,
             Game.STATES.PreGameMultiple: self._button_pressed_PreGameMultiple,
@@ -154,18 +352,20 @@ class Game:
             Game.STATES.PreGameSingle: self._register_PreGameSingle
         }
 
+        self._control_callbacks = {
+            Game.STATES.PreGameSingle: self._control_PreGameSingle,
+            Game.STATES.PreGameMultiple: self._control_PreGameMultiple,
+            Game.STATES.Playing: self._control_Playing,
+            Game.STATES.PlayingAllReleased: self._control_PlayingAllReleased,
+            Game.STATES.Lose: self._control_Lose,
+            Game.STATES.Win: self._control_Win,
+            Game.STATES.WaitRelease: self._control_WaitRelease
+        }
+
         self._control_task: Optional[asyncio.Task] = None
 
     def __repr__(self):
-        return f"""Game:
-            Active:             {self.ACTIVE.values()}
-            State:              {str(self.state)}
-            Correct:            {self.correct}
-            Upcoming list:      {self.unit_list}
-            Wrong:              {self.wrong}
-            Previous Correct:   {self.previous_correct}
-            Pressed Units:      {self.pressed_units}
-"""
+        return repr(GameSnapshot(self))
 
     @property
     def state(self):
@@ -173,12 +373,21 @@ class Game:
 
     @state.setter
     def state(self, next_state: STATES):
-        _logger.info(self)
-        _logger.info(f"Transition {self.state.name}->{next_state.name}")
+        if _logger.isEnabledFor(logging.INFO):
+            _logger.info("%s", GameSnapshot(self))
+            _logger.info("Transition %s->%s", self.state.name, next_state.name,
+                         extra={'event': 'TRANSITION', 'room': self.room,
+                                'from': self.state.name, 'to': next_state.name})
+
+        now = time.monotonic()
+        _state_dwell.labels(self._state.name).observe(now - self._state_since)
+        self._state_since = now
+
         self._state = next_state
 
     def button_pressed(self, unit_id: int):
-        _logger.info(f"Event: Button Pressed, Unit: {unit_id:#x}")
+        _logger.info("Event: Button Pressed, Unit: %#x", unit_id,
+                     extra={'event': 'BUTTON_PRESSED', 'unit': unit_id})
 
         if unit_id in self.ACTIVE:
             unit = self.ACTIVE[unit_id]
@@ -189,7 +398,8 @@ class Game:
             self._button_pressed_callbacks[self.state](unit)
 
     def button_released(self, unit_id: int):
-        _logger.info(f"Event: Button Released, Unit: {unit_id:#x}")
+        _logger.info("Event: Button Released, Unit: %#x", unit_id,
+                     extra={'event': 'BUTTON_RELEASED', 'unit': unit_id})
 
         if unit_id in self.ACTIVE:
             unit = self.ACTIVE[unit_id]
@@ -201,33 +411,142 @@ class Game:
 
     def update_unit_distance(self, unit_id: int, distance: float):
         if unit_id in self.ACTIVE:
-            self.ACTIVE[unit_id].update_distance(distance)
-            _logger.info(f"Updated distance for unit {unit_id:#x} to {distance}")
+            unit = self.ACTIVE[unit_id]
+            # Read by the sequencing strategy when the next round is set up
+            unit.distance = distance
+            unit.update_distance(distance, datetime.now())
+            _logger.debug("Updated distance for unit %#x to %s", unit_id, distance,
+                          extra={'event': 'DISTANCE', 'unit': unit_id, 'distance': distance})
+
+    def replica(self) -> dict[str, Any]:
+        ''' The state a follower needs to take over the game '''
+        return {
+            'state': self.state.name,
+            'active': sorted(self.ACTIVE.keys() | self.expected),
+            'unit_list': list(self.unit_list),
+            'correct': self.correct,
+            'wrong': self.wrong,
+            'previous_correct': sorted(self.previous_correct),
+        }
+
+    def restore(self, replica: dict[str, Any]):
+        ''' Picks up a game replicated from a failed gamemaster '''
+        self._state = Game.STATES[replica['state']]
+        self.expected = set(replica['active'])
+        self.unit_list = order.Order(replica['unit_list'])
+        self.correct = replica['correct']
+        self.wrong = replica['wrong']
+        self.previous_correct = set(replica['previous_correct'])
+
+        if self.state == Game.STATES.NoUnits or not self.expected:
+            # Nothing to resume, the next unit starts a game as usual
+            self._state = Game.STATES.NoUnits
+            self.expected = set()
+            return
+
+        _logger.info("Game: Restored, Room: %s, State: %s, Units: %d", self.room,
+                     self.state.name, len(self.expected),
+                     extra={'event': 'RESTORE', 'room': self.room, 'state': self.state.name})
+
+        self._control_task = asyncio.create_task(self._control_Resume())
+
+    def _resume_unit(self, unit: Unit):
+        timestamp = self._target_time((unit,))
+        if unit.unit_id == self.correct or unit.unit_id in self.previous_correct:
+            unit.correct(timestamp)
+        elif unit.unit_id == self.wrong:
+            unit.wrong(timestamp)
+        else:
+            unit.stop_all(timestamp)
+
+    async def _control_Resume(self):
+        await asyncio.sleep(Game.RESUME_GRACE)
+        self._finish_resume()
+
+    def _finish_resume(self):
+        missing, self.expected = self.expected, set()
+        for unit_id in missing:
+            self.unit_list.discard(unit_id)
+            self.previous_correct.discard(unit_id)
+
+        if missing:
+            _logger.info("Game: Resumed without units %s", [hex(unit_id) for unit_id in missing],
+                         extra={'event': 'RESUME', 'room': self.room, 'missing': len(missing)})
+
+        if self.state in (Game.STATES.Playing, Game.STATES.PlayingAllReleased):
+            if self.correct in missing:
+                self._next_correct()
+            if self.wrong in missing:
+                self._next_wrong()
+        else:
+            # The pre-game control tasks pick their own
+            if self.correct in missing:
+                self.correct = None
+            if self.wrong in missing:
+                self.wrong = None
+
+        if len(self.ACTIVE) == 0:
+            self._control_task = None
+            self.state = Game.STATES.NoUnits
+            if self.abandoned is not None:
+                self.abandoned(self)
+        elif len(self.ACTIVE) == 1 and self.state in (Game.STATES.Playing,
+                                                      Game.STATES.PlayingAllReleased):
+            self._control_task = asyncio.create_task(self._control_Win())
+            self.state = Game.STATES.Win
+        elif len(self.ACTIVE) == 1 and self.state == Game.STATES.PreGameMultiple:
+            self._control_task = asyncio.create_task(self._control_PreGameSingle())
+            self.state = Game.STATES.PreGameSingle
+        else:
+            self._control_task = asyncio.create_task(self._control_callbacks[self.state]())
 
     def register(self, unit_id: int, unit: Unit):
-        _logger.info(f"Event: Unit Register, Unit: {unit}")
+        _logger.info("Event: Unit Register, Unit: %#x", unit_id,
+                     extra={'event': 'REGISTER', 'unit': unit_id})
 
         self.ACTIVE[unit_id] = unit
+        self.active_ids.add(unit_id)
+
+        if unit_id in self.expected:
+            self.expected.discard(unit_id)
+            self._resume_unit(unit)
+            if not self.expected:
+                assert (self._control_task is not None)
+                self._control_task.cancel()
+                self._finish_resume()
+            return
 
         if self.state in (Game.STATES.NoUnits, Game.STATES.PreGameSingle):
             self._register_callbacks[self.state](unit)
 
-        timestamp = datetime.now() + \
-            timedelta(seconds=0.1) + \
-            timedelta(seconds=unit.ws.latency)
+        timestamp = self._target_time((unit,))
 
         unit.stop_all(timestamp)
         simulated_distance = random.uniform(1.0,10.0)
         self.update_unit_distance(unit_id, simulated_distance)
 
     def unregister(self, unit_id: int):
-        _logger.info(f"Event: Unit Unregister, Unit: {unit_id:#x}")
+        _logger.info("Event: Unit Unregister, Unit: %#x", unit_id,
+                     extra={'event': 'UNREGISTER', 'unit': unit_id})
 
-        self.ACTIVE.pop(unit_id, None)
+        unit = self.ACTIVE.pop(unit_id, None)
+        self.active_ids.discard(unit_id)
         self.previous_correct.discard(unit_id)
 
+        if unit is not None and (unit.mailbox.coalesced or unit.mailbox.dropped):
+            _logger.info("Unit %#x mailbox: %d coalesced, %d dropped", unit_id,
+                         unit.mailbox.coalesced, unit.mailbox.dropped,
+                         extra={'event': 'MAILBOX', 'unit': unit_id,
+                                'coalesced': unit.mailbox.coalesced,
+                                'dropped': unit.mailbox.dropped})
+
+        if self.expected:
+            # Still resuming, a unit that left again is one that did not come back
+            self.expected.add(unit_id)
+            return
+
         if unit_id in self.unit_list:
-            self.unit_list.remove(unit_id)
+            self.unit_list.discard(unit_id)
         elif unit_id == self.correct:
             self._next_correct()
             self._next_wrong()
@@ -279,11 +598,7 @@ class Game:
             self.state = Game.STATES.PreGameSingle
 
     def _button_pressed_PreGameSingle(self, unit: Unit):
-        unit.win(f"sounds/win/win{random.randint(1, 8)}.wav",
-                 datetime.now() +
-                 timedelta(seconds=0.1) +
-                 timedelta(seconds=unit.ws.latency)
-                 )
+        unit.win(f"sounds/win/win{random.randint(1, 8)}.wav", self._target_time((unit,)))
 
         assert (self._control_task is not None)
         self._control_task.cancel()
@@ -294,16 +609,13 @@ class Game:
     def _button_pressed_PreGameMultiple(self, unit: Unit):
         if unit.unit_id == self.correct:
             _logger.info("Correct")
-            unit.correct_pressed(datetime.now() +
-                                 timedelta(seconds=0.1) +
-                                 timedelta(seconds=unit.ws.latency)
-                                 )
+            unit.correct_pressed(self._target_time((unit,)))
 
             self.previous_correct = set()
             self.previous_correct.add(unit.unit_id)
 
             self._setup_game()
-            self.unit_list.remove(self.correct)
+            self.unit_list.discard(self.correct)
 
             self._next_correct()
             self._next_wrong()
@@ -316,22 +628,13 @@ class Game:
 
     def _button_pressed_Playing(self, unit: Unit):
         if unit.unit_id in self.previous_correct:
-            unit.correct_pressed(
-                datetime.now() +
-                timedelta(seconds=0.1) +
-                timedelta(seconds=unit.ws.latency)
-            )
+            unit.correct_pressed(self._target_time((unit,)))
         elif unit.unit_id == self.wrong:
-            latency = max(unit.ws.latency for unit in self.pressed_units)
-
             lose_sound = random.randint(1, 6)
-            for unit in self.ACTIVE.values():
-                unit.lose(
-                    f"sounds/lose/lose{lose_sound}.wav",
-                    datetime.now() +
-                    timedelta(seconds=0.1) +
-                    timedelta(seconds=latency)
-                )
+            effect = Effect()
+            effect.lose(f"sounds/lose/lose{lose_sound}.wav",
+                        self._target_time(self.ACTIVE.values()))
+            self._broadcast(effect, self.ACTIVE.values())
 
             assert (self._control_task is not None)
             self._control_task.cancel()
@@ -348,11 +651,7 @@ class Game:
 
                 self.state = Game.STATES.Win
             else:
-                unit.correct_pressed(
-                    datetime.now() +
-                    timedelta(seconds=0.1) +
-                    timedelta(seconds=unit.ws.latency)
-                )
+                unit.correct_pressed(self._target_time((unit,)))
 
                 self.previous_correct.add(unit.unit_id)
 
@@ -361,24 +660,15 @@ class Game:
 
     def _button_pressed_PlayingAllReleased(self, unit: Unit):
         if unit.unit_id in self.previous_correct:
-            unit.correct_pressed(
-                datetime.now() +
-                timedelta(seconds=0.1) +
-                timedelta(seconds=unit.ws.latency)
-            )
+            unit.correct_pressed(self._target_time((unit,)))
 
             self.state = Game.STATES.Playing
         elif unit.unit_id == self.wrong:
-            latency = max(unit.ws.latency for unit in self.pressed_units)
-
             lose_sound = random.randint(1, 6)
-            for pressed_unit in self.pressed_units:
-                pressed_unit.lose(
-                    f"sounds/lose/lose{lose_sound}.wav",
-                    datetime.now() +
-                    timedelta(seconds=0.1) +
-                    timedelta(seconds=latency)
-                )
+            effect = Effect()
+            effect.lose(f"sounds/lose/lose{lose_sound}.wav",
+                        self._target_time(self.pressed_units))
+            self._broadcast(effect, self.pressed_units)
 
             assert (self._control_task is not None)
             self._control_task.cancel()
@@ -397,11 +687,7 @@ class Game:
 
                 self.state = Game.STATES.Win
             else:
-                unit.correct_pressed(
-                    datetime.now() +
-                    timedelta(seconds=0.1) +
-                    timedelta(seconds=unit.ws.latency)
-                )
+                unit.correct_pressed(self._target_time((unit,)))
 
                 self._next_correct()
                 self._next_wrong()
@@ -414,11 +700,7 @@ class Game:
                 self.state = Game.STATES.Playing
 
     def _button_pressed_WaitRelease(self, unit: Unit):
-        unit.start_button_led((0xFF, 0xA5, 0x00),
-                              datetime.now() +
-                              timedelta(seconds=0.1) +
-                              timedelta(seconds=unit.ws.latency)
-                              )
+        unit.start_button_led((0xFF, 0xA5, 0x00), self._target_time((unit,)))
 
     def _button_pressed_Lose(self, unit: Unit):
         pass
@@ -432,9 +714,7 @@ class Game:
     _button_released_Win = _button_released_PreGameSingle
 
     def _button_released_Playing(self, unit: Unit):
-        timestamp = datetime.now() + \
-            timedelta(seconds=0.1) + \
-            timedelta(seconds=unit.ws.latency)
+        timestamp = self._target_time((unit,))
 
         if not self.pressed_units:
             assert (self._control_task is not None)
@@ -445,9 +725,7 @@ class Game:
             self.state = Game.STATES.PlayingAllReleased
 
     def _button_released_WaitRelease(self, unit: Unit):
-        timestamp = datetime.now() +\
-            timedelta(seconds=0.1) + \
-            timedelta(seconds=unit.ws.latency)
+        timestamp = self._target_time((unit,))
         unit.stop_all(timestamp)
 
         self.previous_correct.discard(unit.unit_id)
@@ -468,92 +746,89 @@ class Game:
 
                 self.state = Game.STATES.PreGameSingle
 
+    def _target_time(self, units: Iterable[Unit]) -> datetime:
+        latency = max((unit.latency.percentile(Game.LATENCY_PERCENTILE)
+                       for unit in units), default=0.0)
+
+        return datetime.now() + \
+            timedelta(seconds=0.1) + \
+            timedelta(seconds=latency)
+
+    def _broadcast(self, effect: Effect, units: Iterable[Unit]):
+        for unit in units:
+            unit.send_frames(effect.frames(unit.binary))
+
+    def _broadcast_stop_all(self):
+        effect = Effect()
+        effect.stop_all(self._target_time(self.ACTIVE.values()))
+        self._broadcast(effect, self.ACTIVE.values())
+
     def _setup_game(self):
-        self.unit_list = sorted(self.ACTIVE.keys(), key=lambda uid: self.ACTIVE[uid].distance, reverse=True)
-        random.shuffle(self.unit_list)
+        strategy = order.STRATEGIES[Game.ORDER_STRATEGY]
+        self.unit_list = order.Order(strategy(
+            {unit_id: unit.distance for unit_id, unit in self.ACTIVE.items()}))
 
-        _logger.info(f"Game: Setup, Order: {self.unit_list}")
+        _logger.info("Game: Setup, Order: %s", list(self.unit_list))
 
     def _next_correct(self):
         _logger.info("Picking next correct")
         if self.unit_list:
-            self.correct = self.unit_list.pop(0)
+            self.correct = self.unit_list.popleft()
 
             correct_unit = self.ACTIVE[self.correct]
-            correct_unit.correct(
-                datetime.now() +
-                timedelta(seconds=0.1) +
-                timedelta(seconds=correct_unit.ws.latency)
-            )
+            correct_unit.correct(self._target_time((correct_unit,)))
 
-            _logger.info(f"Game: Next correct, Unit: {self.correct:#x}")
+            _logger.info("Game: Next correct, Unit: %#x", self.correct,
+                         extra={'event': 'CORRECT', 'unit': self.correct})
         else:
             self.correct = None
 
-            _logger.info(f"Game: Next correct, Unit: None")
+            _logger.info("Game: Next correct, Unit: None")
 
     def _next_wrong(self):
         _logger.info("Picking next wrong")
         if self.unit_list:
-            if self.wrong is not None and self.wrong != self.correct:
+            if self.wrong in self.ACTIVE and self.wrong != self.correct:
                 self.ACTIVE[self.wrong].stop_all(datetime.now())
-            self.wrong = random.choice(self.unit_list)
+            self.wrong = self.unit_list.choice()
             wrong_unit = self.ACTIVE[self.wrong]
-            wrong_unit.wrong(
-                datetime.now() +
-                timedelta(seconds=0.1) +
-                timedelta(seconds=wrong_unit.ws.latency)
-            )
-            _logger.info(f"Game: Next wrong, Unit: {self.wrong:#x}")
+            wrong_unit.wrong(self._target_time((wrong_unit,)))
+            _logger.info("Game: Next wrong, Unit: %#x", self.wrong,
+                         extra={'event': 'WRONG', 'unit': self.wrong})
         else:
             self.wrong = None
-            _logger.info(f"Game: Next wrong, Unit: None")
+            _logger.info("Game: Next wrong, Unit: None")
 
     async def _control_PreGameSingle(self):
         if self.correct is not None:
             correct_unit = self.ACTIVE[self.correct]
 
-            timestamp = datetime.now() +\
-                timedelta(seconds=0.1) + \
-                timedelta(seconds=correct_unit.ws.latency)
+            timestamp = self._target_time((correct_unit,))
 
             correct_unit.stop_all(timestamp)
 
-        self.correct = random.choice(list(self.ACTIVE.keys()))
+        self.correct = self.active_ids.choice()
         assert self.correct is not None
         correct_unit = self.ACTIVE[self.correct]
 
-        correct_unit.correct(
-            datetime.now() +
-            timedelta(seconds=0.1) +
-            timedelta(seconds=correct_unit.ws.latency)
-        )
+        correct_unit.correct(self._target_time((correct_unit,)))
 
-        _logger.info(f"Game: Next correct, Unit: {self.correct:#x}")
+        _logger.info("Game: Next correct, Unit: %#x", self.correct,
+                     extra={'event': 'CORRECT', 'unit': self.correct})
 
     async def _control_PreGameMultiple(self):
         while True:
             if self.correct is not None:
                 correct_unit = self.ACTIVE[self.correct]
 
-                correct_unit.stop_all(
-                    datetime.now() +
-                    timedelta(seconds=0.1) +
-                    timedelta(seconds=correct_unit.ws.latency)
-                )
-            while self.correct == (next_unit := random.choice(list(self.ACTIVE.keys()))):
-                pass
-
-            self.correct = next_unit
+                correct_unit.stop_all(self._target_time((correct_unit,)))
+            self.correct = self.active_ids.choice(exclude=self.correct)
             correct_unit = self.ACTIVE[self.correct]
 
-            correct_unit.correct(
-                datetime.now() +
-                timedelta(seconds=0.1) +
-                timedelta(seconds=correct_unit.ws.latency)
-            )
+            correct_unit.correct(self._target_time((correct_unit,)))
 
-            _logger.info(f"Game: Next correct, Unit: {self.correct:#x}")
+            _logger.info("Game: Next correct, Unit: %#x", self.correct,
+                         extra={'event': 'CORRECT', 'unit': self.correct})
 
             await asyncio.sleep(10)
 
@@ -561,13 +836,9 @@ class Game:
         await asyncio.sleep(10)
         for unit in self.pressed_units:
             unit.start_button_led(
-                "flash_blue",
-                datetime.now() +
-                timedelta(seconds=0.1) +
-                timedelta(seconds=unit.ws.latency)
-            )
+                "flash_blue", self._target_time((unit,)))
 
-            _logger.info(f"Event: Button held, Units: {self.pressed_units}")
+            _logger.info("Event: Button held, Units: %s", set(self.pressed_units))
 
     async def _control_Playing(self):
         pass
@@ -576,13 +847,14 @@ class Game:
         await asyncio.sleep(15)
 
         lose_sound = random.randint(1, 6)
-        for unit in self.ACTIVE.values():
-            unit.lose(f"sounds/lose/lose{lose_sound}.wav", datetime.now())
+        effect = Effect()
+        effect.lose(f"sounds/lose/lose{lose_sound}.wav",
+                    self._target_time(self.ACTIVE.values()))
+        self._broadcast(effect, self.ACTIVE.values())
 
         await asyncio.sleep(4)
 
-        for unit in self.ACTIVE.values():
-            unit.stop_all(datetime.now())
+        self._broadcast_stop_all()
 
         if not self.pressed_units:
             if len(self.ACTIVE) > 1:
@@ -602,15 +874,14 @@ class Game:
 
     async def _control_Lose(self):
         lose_sound = random.randint(1, 6)
-        for unit in self.ACTIVE.values():
-            unit.lose(
-                f"sounds/lose/lose{lose_sound}.wav",
-                datetime.now())
+        effect = Effect()
+        effect.lose(f"sounds/lose/lose{lose_sound}.wav",
+                    self._target_time(self.ACTIVE.values()))
+        self._broadcast(effect, self.ACTIVE.values())
 
         await asyncio.sleep(10)
 
-        for unit in self.ACTIVE.values():
-            unit.stop_all(datetime.now())
+        self._broadcast_stop_all()
 
         await asyncio.sleep(10)
         if len(self.ACTIVE) > 1:
@@ -632,13 +903,14 @@ class Game:
 
     async def _control_Win(self):
         win_sound = random.randint(1, 8)
-        for unit in self.ACTIVE.values():
-            unit.win(f"sounds/win/win{win_sound}.wav", datetime.now())
+        effect = Effect()
+        effect.win(f"sounds/win/win{win_sound}.wav",
+                   self._target_time(self.ACTIVE.values()))
+        self._broadcast(effect, self.ACTIVE.values())
 
         await asyncio.sleep(10)
 
-        for unit in self.ACTIVE.values():
-            unit.stop_all(datetime.now())
+        self._broadcast_stop_all()
 
         await asyncio.sleep(10)
 
@@ -660,6 +932,201 @@ class Game:
             self.state = Game.STATES.PreGameSingle
 
 
+class Rooms:
+    ''' The independent games served by this gamemaster, one per room '''
+
+    def __init__(self) -> None:
+        self.games: dict[str, Game] = {}
+
+    def join(self, room: str) -> Game:
+        if room not in self.games:
+            _logger.info("Room %s opened", room, extra={'event': 'ROOM_OPEN', 'room': room})
+            self.games[room] = Game(room)
+
+        return self.games[room]
+
+    def leave(self, room: str, unit_id: int):
+        game = self.games.get(room)
+        if game is None:
+            return
+
+        game.unregister(unit_id)
+
+        # A restored game waits for its units even while nobody is connected
+        if not game.ACTIVE and not game.expected:
+            self._close(game)
+
+    def _close(self, game: Game):
+        if self.games.get(game.room) is game:
+            _logger.info("Room %s closed", game.room, extra={'event': 'ROOM_CLOSE', 'room': game.room})
+            del self.games[game.room]
+
+    def restore(self, replica: dict[str, dict[str, Any]]):
+        for room, state in replica.items():
+            if room in self.games:
+                continue
+
+            game = Game(room)
+            game.restore(state)
+            # Nobody to wait for, the room opens again with its first unit
+            if game.state == Game.STATES.NoUnits:
+                continue
+            game.abandoned = self._close
+            self.games[room] = game
+
+    def __len__(self) -> int:
+        return len(self.games)
+
+
+class Connections:
+    ''' Owns the Unit of every connection, so none outlives its handler '''
+
+    def __init__(self, rooms: Rooms, ssl_context: Optional[ssl.SSLContext] = None) -> None:
+        self.rooms = rooms
+        self.ssl_context = ssl_context
+        self.sockets: set[WebSocketServerProtocol] = set()
+        self.units: dict[int, Unit] = {}
+        self.unit_rooms: dict[int, str] = {}
+
+    def register(self, websocket: WebSocketServerProtocol, unit_id: int, room: str,
+                 features: Iterable[str]) -> tuple[Unit, Game, Optional[Unit]]:
+        '''
+        Swaps in a new Unit for the id without yielding to the loop, any
+        previous Unit of the id is returned and must be closed by the caller
+        '''
+        previous = self.units.pop(unit_id, None)
+        if previous is not None:
+            _logger.info("Unit %#x registered again, replacing its connection", unit_id,
+                         extra={'event': 'REPLACE', 'unit': unit_id})
+            self.rooms.leave(self.unit_rooms.pop(unit_id), unit_id)
+
+        unit = self.units[unit_id] = Unit(websocket, unit_id, features)
+        self.unit_rooms[unit_id] = room
+        game = self.rooms.join(room)
+        game.register(unit_id, unit)
+
+        return unit, game, previous
+
+    async def release(self, unit: Optional[Unit]):
+        ''' Takes the unit out of its game unless it was replaced already '''
+        if unit is None:
+            return
+
+        if self.units.get(unit.unit_id) is unit:
+            del self.units[unit.unit_id]
+            self.rooms.leave(self.unit_rooms.pop(unit.unit_id), unit.unit_id)
+
+        await unit.close()
+
+    async def replace(self, previous: Optional[Unit]):
+        if previous is None:
+            return
+
+        await previous.close()
+        if previous.ws not in self.sockets:
+            return
+        # The old handler finds its unit replaced and exits without touching the game
+        await previous.ws.close()
+
+    def report(self):
+        tls = self.ssl_context.session_stats() if self.ssl_context is not None else {}
+        _logger.info("Connections: %d, units: %d, rooms: %d, tasks: %d, TLS handshakes: %d (%d resumed)",
+                     len(self.sockets), len(self.units), len(self.rooms),
+                     len(asyncio.all_tasks()), tls.get('accept_good', 0), tls.get('hits', 0),
+                     extra={'event': 'CONNECTIONS', 'connections': len(self.sockets),
+                            'units': len(self.units), 'rooms': len(self.rooms),
+                            'tasks': len(asyncio.all_tasks()),
+                            'tls_handshakes': tls.get('accept_good', 0),
+                            'tls_resumed': tls.get('hits', 0)})
+
+
+async def report_periodically(connections: Connections, interval: float = 60.0):
+    while True:
+        await asyncio.sleep(interval)
+        connections.report()
+
+
+class PeerLink:
+    '''
+    Persistent websocket to another gamemaster. Requests are the paths of the
+    HTTP interface and are answered in order over the same connection.
+    '''
+
+    def __init__(self, url: str, ssl: ssl.SSLContext) -> None:
+        self.url = url
+        self.ssl = ssl
+        self.socket = None
+        self.lock = asyncio.Lock()
+        self.suspected_until = 0.0
+
+    def suspect(self):
+        self.suspected_until = time.monotonic() + PEER_SUSPECT_PERIOD
+
+    @property
+    def suspected(self) -> bool:
+        return time.monotonic() < self.suspected_until
+
+    async def _connect(self):
+        if self.socket is None or self.socket.closed:
+            self.socket = await asyncio.wait_for(
+                connect(f"wss://{self.url}:8002{PEER_PATH}", ssl=self.ssl, ping_interval=None),
+                PEER_TIMEOUT)
+        return self.socket
+
+    async def get(self, path: str) -> Optional[tuple[int, str]]:
+        ''' Status and body of the path, None if the peer did not answer '''
+        if self.suspected:
+            return None
+
+        async with self.lock:
+            try:
+                socket = await self._connect()
+                await socket.send(json.dumps({'path': path}))
+                response = json.loads(await asyncio.wait_for(socket.recv(), PEER_TIMEOUT))
+                return response['status'], response['body']
+            except (OSError, asyncio.TimeoutError, WebSocketException) as e:
+                _logger.info("Peer %s failed: %r", self.url, e,
+                             extra={'event': 'PEER_FAILED', 'peer': self.url})
+                self.suspect()
+                self.abort()
+                return None
+
+    async def wait_failed(self):
+        ''' Returns once the heartbeat to the peer is lost '''
+        try:
+            socket = await self._connect()
+        except (OSError, asyncio.TimeoutError, WebSocketException):
+            self.suspect()
+            return
+
+        # Own heartbeat rather than the keepalive of websockets, which would
+        # wait for a closing handshake that a hung peer never completes
+        try:
+            while True:
+                pong = await socket.ping()
+                await asyncio.wait_for(pong, PEER_PING_TIMEOUT)
+                await asyncio.sleep(PEER_PING_INTERVAL)
+        except (asyncio.TimeoutError, WebSocketException):
+            pass
+
+        self.suspect()
+        if self.socket is socket:
+            self.abort()
+        else:
+            socket.transport.abort()
+
+    def abort(self):
+        ''' Drops the connection without the closing handshake a hung peer never answers '''
+        if self.socket is not None:
+            socket, self.socket = self.socket, None
+            socket.transport.abort()
+
+    async def close(self):
+        if self.socket is not None:
+            socket, self.socket = self.socket, None
+            await socket.close()
+
+
 class Gamemaster():
     def __init__(self, url: str, priority: int, gamemaster_urls: list[str], ssl: ssl.SSLContext):
         self.gamemaster_urls = gamemaster_urls
@@ -669,52 +1136,70 @@ class Gamemaster():
         self.priority = priority
 
         self.active_gamemaster = ''
+        self.peers = {url: PeerLink(url, ssl)
+                      for url in gamemaster_urls if url != self.url}
 
-    async def _get_is_gamemaster(self, session: aiohttp.ClientSession, url: str):
-        try:
-            async with session.get(f"https://{url}:8002/gamemaster",
-                                   ssl=self.ca_certificate,
-                                   timeout=1) as response:
-                if response.status == http.HTTPStatus.FOUND:
-                    self.active_gamemaster = await response.text()
-                    return True
-        except (aiohttp.TooManyRedirects, aiohttp.ClientConnectionError):
-            pass
+        self.lost_at: Optional[float] = None
+        self.replica = Replica()
+
+    def _peer(self, url: str) -> PeerLink:
+        if url not in self.peers:
+            self.peers[url] = PeerLink(url, self.ca_certificate)
+        return self.peers[url]
+
+    async def _get_is_gamemaster(self, peer: PeerLink):
+        response = await peer.get('/gamemaster')
+        if response is not None and response[0] == http.HTTPStatus.FOUND:
+            self.active_gamemaster = response[1].strip()
+            return True
 
         return False
 
     async def get_gamemaster(self):
-        async with aiohttp.ClientSession(timeout=1) as session:
-            return any(await asyncio.gather(
-                *(self._get_is_gamemaster(session, url)
-                  for url in self.gamemaster_urls if url != self.url))
-            )
-
-    async def _request_gamemaster(self, session: aiohttp.ClientSession, url: str):
-        try:
-            async with session.get(f"https://{url}:8002/request_gamemaster",
-                                   ssl=self.ca_certificate) as response:
-                if response.status == http.HTTPStatus.OK:
-                    return True
-                elif response.status == http.HTTPStatus.CONFLICT:
-                    if int(await response.text()) > self.priority:
-                        self.active_gamemaster = url
-                        return False
-                    else:
-                        return True
-                elif response.status == http.HTTPStatus.FOUND:
-                    self.active_gamemaster = url
-                    return False
-        except (aiohttp.TooManyRedirects, aiohttp.ClientConnectionError):
-            pass
+        return any(await asyncio.gather(
+            *(self._get_is_gamemaster(peer) for peer in self.peers.values())))
+
+    async def _request_gamemaster(self, peer: PeerLink):
+        response = await peer.get('/request_gamemaster')
+        if response is None:
+            return True
+
+        status, body = response
+        if status == http.HTTPStatus.OK:
+            return True
+        elif status == http.HTTPStatus.CONFLICT:
+            if int(body) > self.priority:
+                self.active_gamemaster = peer.url
+                return False
+            else:
+                return True
+        elif status == http.HTTPStatus.FOUND:
+            self.active_gamemaster = peer.url
+            return False
 
         return True
 
     async def request_gamemaster(self):
-        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(1)) as session:
-            return all(await asyncio.gather(
-                *(self._request_gamemaster(session, url)
-                    for url in self.gamemaster_urls if url != self.url)))
+        return all(await asyncio.gather(
+            *(self._request_gamemaster(peer) for peer in self.peers.values())))
+
+    async def follow(self):
+        '''
+        Holds a heartbeat link to the active gamemaster until it fails, while
+        replicating its game state
+        '''
+        replicate_task = asyncio.create_task(
+            self.replica.receive(self.active_gamemaster, self.ca_certificate))
+        try:
+            await self._peer(self.active_gamemaster).wait_failed()
+        finally:
+            replicate_task.cancel()
+        self.lost_at = time.perf_counter()
+        _logger.info("Lost gamemaster %s", self.active_gamemaster,
+                     extra={'event': 'GAMEMASTER_LOST', 'peer': self.active_gamemaster})
+
+    async def close(self):
+        await asyncio.gather(*(peer.close() for peer in self.peers.values()))
 
 
 class GamemasterFSM():
@@ -745,6 +1230,10 @@ class GamemasterFSM():
         if await self.model.request_gamemaster():
             print("Become GM")
             self._state = GamemasterFSM.STATES.Gamemaster
+            if self.model.lost_at is not None:
+                elapsed = time.perf_counter() - self.model.lost_at
+                _logger.info("Took over %.3fs after losing the gamemaster", elapsed,
+                             extra={'event': 'GAMEMASTER_ELECTED', 'elapsed': elapsed})
         else:
             print("Found GM Enter End")
             self._state = GamemasterFSM.STATES.End
@@ -758,56 +1247,120 @@ class GamemasterFSM():
         self._state = GamemasterFSM.STATES.Initial
 
 
-async def handler(websocket: WebSocketServerProtocol, game: Game):
-    unit_id = None
+async def handler(websocket: WebSocketServerProtocol, connections: Connections):
+    unit: Optional[Unit] = None
+    game: Optional[Game] = None
+    connections.sockets.add(websocket)
     try:
         async for msg in websocket:
+            received = time.time()
+            _journal.record(journal.Kind.INBOUND, unit.unit_id if unit is not None else None,
+                            msg if isinstance(msg, bytes) else msg.encode())
             decoded = json.loads(msg)
 
-            if decoded['type'] == 'REGISTER':
+            counter = _event_counters.get(decoded['type'])
+            if counter is not None:
+                counter.inc()
+
+            if decoded['type'] == 'CLOCK_PING':
+                # Answered right away, queueing behind commands would skew t2
+                await websocket.send(protocol.encode_json(
+                    {'type': 'CLOCK_PONG', 't0': decoded['t0'],
+                     't1': received, 't2': time.time()}))
+            elif decoded['type'] == 'REGISTER':
                 await websocket.ping()
-                unit_id = int(decoded['id'], 16)
-                game.register(unit_id, Unit(websocket, unit_id))
+                await connections.release(unit)
+
+                unit, game, previous = connections.register(
+                    websocket, int(decoded['id'], 16),
+                    decoded.get('room', DEFAULT_ROOM), decoded.get('features', ()))
+                await connections.replace(previous)
             elif decoded['type'] == 'BUTTON_PRESSED':
                 print("Handle button press")
-                if unit_id is not None:
-                    game.button_pressed(unit_id)
+                if unit is not None and game is not None:
+                    trace = tracing.Trace(decoded.get('trace'), decoded.get('callback'),
+                                          time.perf_counter())
+                    unit.tracing = trace
+                    try:
+                        game.button_pressed(unit.unit_id)
+                    finally:
+                        unit.tracing = None
+                    trace.dispatched = time.perf_counter()
+                    # Presses that command nothing to the unit are not measured
+                    if len(unit.mailbox):
+                        unit.pressed = trace
+            elif decoded['type'] == 'RENDERED':
+                if unit is not None:
+                    unit.rendered(decoded)
             elif decoded['type'] == 'BUTTON_RELEASED':
                 print("Handle button release")
-                if unit_id is not None:
-                    game.button_released(unit_id)
+                if unit is not None and game is not None:
+                    game.button_released(unit.unit_id)
             elif decoded['type'] == 'DISTANCE_UPDATE':
-                if unit_id is not None:
+                if unit is not None and game is not None:
                     distance = float(decoded['distance'])
-                    game.update_unit_distance(unit_id, distance)
+                    game.update_unit_distance(unit.unit_id, distance)
             elif decoded['type'] == 'UNREGISTER':
-                if unit_id is not None:
-                    game.unregister(unit_id)
+                if unit is not None:
+                    await connections.release(unit)
+                    unit = None
                     break
     except ConnectionClosedError as e:
-        if unit_id is not None:
+        if unit is not None:
             print("Unit disconnected with", e)
-            game.unregister(unit_id)
+    finally:
+        connections.sockets.discard(websocket)
+        if unit is not None and connections.units.get(unit.unit_id) is unit:
+            _journal.record(journal.Kind.DISCONNECT, unit.unit_id, b'')
+        await connections.release(unit)
 
 
-async def process_request(path, req_headers, game_params: GamemasterFSM):
-    if path == '/alive':
+def answer(path: str, game_params: GamemasterFSM) -> Optional[tuple[int, str]]:
+    if path in ('/alive', '/gamemaster'):
         if game_params._state == GamemasterFSM.STATES.Gamemaster:
-            return http.HTTPStatus.FOUND, [], f'{game_params.model.url}\n'.encode()
+            return http.HTTPStatus.FOUND, f'{game_params.model.url}\n'
         else:
-            return http.HTTPStatus.OK, [], f'{game_params.model.active_gamemaster}\n'.encode()
-    elif path == '/gamemaster':
-        if game_params._state == GamemasterFSM.STATES.Gamemaster:
-            return http.HTTPStatus.FOUND, [], f'{game_params.model.url}\n'.encode()
-        else:
-            return http.HTTPStatus.OK, [], f'{game_params.model.active_gamemaster}\n'.encode()
+            return http.HTTPStatus.OK, f'{game_params.model.active_gamemaster}\n'
     elif path == '/request_gamemaster':
         if game_params._state in {GamemasterFSM.STATES.Initial, GamemasterFSM.STATES.End}:
-            return http.HTTPStatus.OK, [], b''
+            return http.HTTPStatus.OK, ''
         elif game_params._state == GamemasterFSM.STATES.Intent:
-            return http.HTTPStatus.CONFLICT, [], f'{game_params.model.priority}\n'.encode()
+            return http.HTTPStatus.CONFLICT, f'{game_params.model.priority}\n'
         elif game_params._state == GamemasterFSM.STATES.Gamemaster:
-            return http.HTTPStatus.FOUND, [], f'{game_params.model.url}\n'.encode()
+            return http.HTTPStatus.FOUND, f'{game_params.model.url}\n'
+
+    return None
+
+
+async def process_request(path, req_headers, game_params: GamemasterFSM):
+    if path == METRICS_PATH:
+        return http.HTTPStatus.OK, [('Content-Type', 'text/plain; version=0.0.4')], \
+            metrics.REGISTRY.render().encode()
+
+    response = answer(path, game_params)
+    if response is not None:
+        status, body = response
+        return status, [], body.encode()
+
+    if path == UNITS_PATH and game_params._state != GamemasterFSM.STATES.Gamemaster:
+        # Units attach wherever they land, the gamemaster is one redirect away
+        active = game_params.model.active_gamemaster
+        if active and active != game_params.model.url:
+            return http.HTTPStatus.FOUND, [('Location', f'wss://{active}:8002{UNITS_PATH}')], b''
+        return http.HTTPStatus.SERVICE_UNAVAILABLE, [], b''
+    elif path not in (UNITS_PATH, PEER_PATH, REPLICATE_PATH):
+        return http.HTTPStatus.NOT_FOUND, [], b''
+
+
+async def peer_handler(websocket: WebSocketServerProtocol, game_params: GamemasterFSM):
+    ''' The HTTP interface over the persistent link of another gamemaster '''
+    try:
+        async for msg in websocket:
+            response = answer(json.loads(msg)['path'], game_params)
+            status, body = response if response is not None else (http.HTTPStatus.NOT_FOUND, '')
+            await websocket.send(json.dumps({'status': status, 'body': body}))
+    except ConnectionClosedError:
+        pass
 
 
 def parse_arguments(args: list[str]):
@@ -832,40 +1385,110 @@ def parse_arguments(args: list[str]):
                         metavar='path',
                         help='The path to the CA certificate', required=True)
 
+    parser.add_argument('--log-file', metavar='path', default='game.log')
+
+    parser.add_argument('--log-json', action='store_true',
+                        help='Write the log as JSON lines')
+
+    parser.add_argument('--journal', metavar='path',
+                        help='Record every unit event and command to a replayable journal')
+
+    parser.add_argument('--order', choices=sorted(order.STRATEGIES), default=Game.ORDER_STRATEGY,
+                        help='How the units of a round are sequenced')
+
+    parser.add_argument('--legacy-port', action='store_true',
+                        help='Also accept units on port 8001 while gamemaster')
+
     return parser.parse_args(args)
 
 
 async def main(args: list[str]):
     options = parse_arguments(args)
 
-    game = Game()
+    log_writer = logpipe.start(options.log_file, options.log_json)
+
+    Game.ORDER_STRATEGY = options.order
+
+    flush_task: Optional[asyncio.Task] = None
+    if options.journal:
+        global _journal
+        _journal = journal.Journal(options.journal)
+
+        seed = random.randrange(2 ** 32)
+        random.seed(seed)
+        _journal.seed(seed)
+
+        flush_task = asyncio.create_task(journal.flush_periodically(_journal))
 
     ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
     ssl_context.load_cert_chain(options.certificate, options.key)
+    # Session tickets let reconnecting units resume instead of a full handshake
+    ssl_context.options &= ~ssl.OP_NO_TICKET
+
+    connections = Connections(Rooms(), ssl_context)
+    report_task = asyncio.create_task(report_periodically(connections))
+
+    metrics.gauge('gamemaster_connections', 'Open unit websockets',
+                  function=lambda: len(connections.sockets))
+    metrics.gauge('gamemaster_units', 'Registered units',
+                  function=lambda: len(connections.units))
+    metrics.gauge('gamemaster_rooms', 'Rooms with a game',
+                  function=lambda: len(connections.rooms))
+    metrics.gauge('gamemaster_mailbox_pending', 'Commands waiting in unit mailboxes',
+                  function=lambda: sum(len(unit.mailbox) for unit in connections.units.values()))
+    metrics.gauge('gamemaster_mailbox_pending_max', 'Commands waiting in the fullest unit mailbox',
+                  function=lambda: max((len(unit.mailbox) for unit in connections.units.values()),
+                                       default=0))
+    metrics.gauge('gamemaster_is_gamemaster', '1 while this node is the active gamemaster',
+                  function=lambda: int(gamemaster_state._state == GamemasterFSM.STATES.Gamemaster))
+
+    replicator = Replicator(connections.rooms)
+    replicate_task = asyncio.create_task(replicator.run())
+
+    peer_ssl_context = tlssession.ResumingSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    peer_ssl_context.load_verify_locations(options.ca_certificate)
 
     gamemaster_params = Gamemaster(
         options.url,
         options.priority,
         options.gamemaster_urls,
-        ssl_context)
+        peer_ssl_context)
     gamemaster_state = GamemasterFSM(gamemaster_params)
 
     async def process_wrap(path, req_h):
         return await process_request(path, req_h, gamemaster_state)
 
-    # Refactor: Push everything to the same server port
-    async with serve(lambda x: handler(x, Game()), options.url, 8002, ping_interval=5, ssl=ssl_context, process_request=process_wrap):
-        while True:
-            if gamemaster_state._state == gamemaster_state.STATES.Gamemaster:
-                async with serve(lambda x: handler(x, game), options.url, 8001, ping_interval=5, ssl=ssl_context):
-                    await asyncio.Future()  # run forever
-            elif gamemaster_state._state == gamemaster_state.STATES.End:
-                try:
-                    async with connect(f"wss://{gamemaster_params.active_gamemaster}:8002", ssl=ssl_context) as socket:
+    async def route(websocket: WebSocketServerProtocol):
+        if websocket.path == PEER_PATH:
+            await peer_handler(websocket, gamemaster_state)
+        elif websocket.path == REPLICATE_PATH:
+            await replicator.serve(websocket)
+        else:
+            await handler(websocket, connections)
+
+    try:
+        async with serve(route, options.url, 8002, ping_interval=5, ssl=ssl_context, process_request=process_wrap):
+            while True:
+                if gamemaster_state._state == gamemaster_state.STATES.Gamemaster:
+                    replica = gamemaster_params.replica.take()
+                    if replica is not None:
+                        connections.rooms.restore(replica)
+                    if options.legacy_port:
+                        async with serve(lambda x: handler(x, connections), options.url, 8001, ping_interval=5, ssl=ssl_context):
+                            await asyncio.Future()  # run forever
+                    else:
                         await asyncio.Future()
-                except ConnectionClosedError:
-                    pass
-            await gamemaster_state.step()
+                elif gamemaster_state._state == gamemaster_state.STATES.End:
+                    await gamemaster_params.follow()
+                await gamemaster_state.step()
+    finally:
+        await gamemaster_params.close()
+        if flush_task is not None:
+            flush_task.cancel()
+            await asyncio.gather(flush_task, return_exceptions=True)
+        _journal.close()
+        log_writer.stop()
+
 
 if __name__ == "__main__":
     asyncio.run(main(sys.argv[1:]))
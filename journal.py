@@ -0,0 +1,190 @@
+'''
+Append-only binary journal of a game session and a tool to replay it.
+
+Every record is a fixed header followed by the raw frame:
+
+    kind (u8) | monotonic time in ns (i64) | unit id (i64) | length (u32) | payload
+
+Inbound frames are stored exactly as the unit sent them and outbound frames
+exactly as they were queued for the unit, so the journal is also a capture of
+the wire traffic. The random seed of the session is journalled too, which
+makes a replay take the same decisions as the original game.
+
+A restarted gamemaster appends a new session to the same journal, starting
+with its SEED record. Monotonic times are only comparable within a session,
+so the replay re-bases its clock on every SEED and lets the units of the
+previous session go.
+
+    python journal.py game.journal                 # as fast as possible
+    python journal.py game.journal --speed 10      # ten times real time
+'''
+
+import argparse
+import asyncio
+from enum import IntEnum
+import json
+import random
+import struct
+import sys
+import time
+from typing import Iterator, Optional
+
+MAGIC = b'NGJ1'
+
+Kind = IntEnum('Kind', ['SEED', 'INBOUND', 'OUTBOUND', 'DISCONNECT'])
+
+RECORD = struct.Struct('!BqqI')
+SEED = struct.Struct('!Q')
+
+NO_UNIT = -1
+
+
+class Journal:
+    ''' Buffered writer, records only reach the disk on flush() or close() '''
+
+    def __init__(self, path: str, buffer_size: int = 1 << 20) -> None:
+        self.file = open(path, 'ab', buffering=buffer_size)
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+
+    def record(self, kind: Kind, unit_id: Optional[int], payload: bytes):
+        self.file.write(RECORD.pack(kind, time.monotonic_ns(),
+                                    NO_UNIT if unit_id is None else unit_id,
+                                    len(payload)))
+        self.file.write(payload)
+
+    def seed(self, seed: int):
+        self.record(Kind.SEED, None, SEED.pack(seed))
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class NullJournal(Journal):
+    def __init__(self) -> None:
+        pass
+
+    def record(self, kind: Kind, unit_id: Optional[int], payload: bytes):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+async def flush_periodically(journal: Journal, interval: float = 1.0):
+    while True:
+        await asyncio.sleep(interval)
+        journal.flush()
+
+
+def read(path: str) -> Iterator[tuple[Kind, int, int, bytes]]:
+    with open(path, 'rb') as journal:
+        data = journal.read()
+
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError(f"{path} is not a game journal")
+
+    offset = len(MAGIC)
+    while offset + RECORD.size <= len(data):
+        kind, t_ns, unit_id, length = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        yield Kind(kind), t_ns, unit_id, data[offset:offset + length]
+        offset += length
+
+
+async def replay(harness, path: str):
+    ''' Feeds the inbound events of a journal to the harness' Game '''
+    start: Optional[int] = None
+    # Replay time at which the current session started
+    offset = 0.0
+    t = 0.0
+    for kind, t_ns, unit_id, payload in read(path):
+        if kind == Kind.SEED:
+            # A new session, its units reconnect and register again
+            for previous in list(harness.units):
+                await harness.dispatch(t, 'UNREGISTER', previous)
+            start, offset = t_ns, t
+        elif start is None:
+            start = t_ns
+        t = offset + (t_ns - start) / 1e9
+
+        if kind == Kind.SEED:
+            (seed,) = SEED.unpack(payload)
+            random.seed(seed)
+        elif kind == Kind.DISCONNECT:
+            await harness.dispatch(t, 'UNREGISTER', unit_id)
+        elif kind == Kind.INBOUND:
+            decoded = json.loads(payload)
+            if decoded['type'] == 'REGISTER':
+                await harness.dispatch(t, 'REGISTER', int(decoded['id'], 16),
+                                       decoded.get('features', ()), decoded.get('room'))
+            elif decoded['type'] == 'DISTANCE_UPDATE':
+                await harness.dispatch(t, 'DISTANCE_UPDATE', unit_id,
+                                       float(decoded['distance']))
+            elif decoded['type'] in ('BUTTON_PRESSED', 'BUTTON_RELEASED', 'UNREGISTER') \
+                    and unit_id != NO_UNIT:
+                await harness.dispatch(t, decoded['type'], unit_id)
+
+    await harness.shutdown()
+
+
+def parse_arguments(args: list[str]):
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('journal', metavar='path')
+    parser.add_argument('--speed', type=float,
+                        help='Replay at this multiple of real time, default is as fast as possible')
+    parser.add_argument('--profile', metavar='path',
+                        help='Write cProfile statistics of the replay')
+    parser.add_argument('--record', metavar='path',
+                        help='Write the replayed events as a bench_game trace')
+
+    return parser.parse_args(args)
+
+
+def main(args: list[str]):
+    import bench_game
+
+    options = parse_arguments(args)
+
+    if options.speed:
+        loop: asyncio.SelectorEventLoop = bench_game.ScaledTimeLoop(options.speed)
+    else:
+        loop = bench_game.VirtualTimeLoop()
+    asyncio.set_event_loop(loop)
+
+    bench_game.gamemaster._logger.disabled = True
+    harness = bench_game.Harness(loop, [], False)
+
+    profiler = None
+    if options.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    start = time.perf_counter()
+    loop.run_until_complete(replay(harness, options.journal))
+    wall = time.perf_counter() - start
+
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(options.profile)
+
+    bench_game.report(harness, wall)
+
+    if options.record:
+        with open(options.record, 'w') as trace:
+            for step in harness.trace:
+                trace.write(json.dumps(step) + '\n')
+
+    loop.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
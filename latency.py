@@ -0,0 +1,83 @@
+'''
+Round trip time tracking for a single unit connection.
+
+Keeps the smoothed estimate and variation the way TCP does (RFC 6298) and a
+sliding window of raw samples for percentiles.
+'''
+
+import asyncio
+from collections import deque
+import time
+from typing import Optional
+
+from websockets.exceptions import ConnectionClosed
+
+# Used until the first probe returns
+INITIAL_RTT = 0.05
+
+PROBE_INTERVAL = 0.5
+PROBE_TIMEOUT = 2.0
+
+
+class LatencyTracker:
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+
+    def __init__(self, window: int = 64) -> None:
+        self.samples: deque[float] = deque(maxlen=window)
+        self.ewma: Optional[float] = None
+        self.jitter = 0.0
+        self.lost = 0
+
+        self._sorted: Optional[list[float]] = None
+
+    def add_sample(self, rtt: float):
+        if self.ewma is None:
+            self.ewma = rtt
+            self.jitter = rtt / 2
+        else:
+            self.jitter += LatencyTracker.BETA * (abs(rtt - self.ewma) - self.jitter)
+            self.ewma += LatencyTracker.ALPHA * (rtt - self.ewma)
+
+        self.samples.append(rtt)
+        self._sorted = None
+
+    def percentile(self, p: float) -> float:
+        if not self.samples:
+            return INITIAL_RTT
+
+        if self._sorted is None:
+            self._sorted = sorted(self.samples)
+
+        index = min(len(self._sorted) - 1, int(len(self._sorted) * p / 100))
+        return self._sorted[index]
+
+    @property
+    def p95(self) -> float:
+        return self.percentile(95)
+
+    @property
+    def p99(self) -> float:
+        return self.percentile(99)
+
+    def __repr__(self) -> str:
+        return f"ewma={self.ewma} jitter={self.jitter:.4f} p95={self.p95:.4f} p99={self.p99:.4f}"
+
+
+async def probe(ws, tracker: LatencyTracker, interval: float = PROBE_INTERVAL):
+    ''' Measures the round trip with websocket pings, every unit answers them '''
+    try:
+        while True:
+            sent = time.perf_counter()
+            pong = await ws.ping()
+            try:
+                await asyncio.wait_for(pong, PROBE_TIMEOUT)
+            except asyncio.TimeoutError:
+                tracker.lost += 1
+                tracker.add_sample(PROBE_TIMEOUT)
+            else:
+                tracker.add_sample(time.perf_counter() - sent)
+
+            await asyncio.sleep(interval)
+    except ConnectionClosed:
+        pass
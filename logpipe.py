@@ -0,0 +1,121 @@
+'''
+Logging that never blocks the event loop.
+
+Records are put on a queue as they are, without formatting, and a writer
+thread formats them, writes them in batches and rotates the file. Callers
+must therefore pass immutable values (or snapshots) as the record arguments,
+they are read later from another thread.
+'''
+
+from datetime import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+
+# Attributes every LogRecord has, anything else came in through extra=
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Formatting is left to the writer thread
+        return record
+
+
+class StructuredFormatter(logging.Formatter):
+    ''' One JSON object per line, with the extra= fields as keys '''
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='microseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, default=repr)
+
+
+class LogWriter(threading.Thread):
+    BATCH = 512
+
+    def __init__(self, log_queue: queue.SimpleQueue, filename: str,
+                 formatter: logging.Formatter, max_bytes: int, backup_count: int) -> None:
+        super().__init__(name='log-writer', daemon=True)
+        self.queue = log_queue
+        self.formatter = formatter
+        # Only used for its rollover logic, records never go through emit()
+        self.file = logging.handlers.RotatingFileHandler(
+            filename, maxBytes=max_bytes, backupCount=backup_count)
+
+    def _write(self, records: list[logging.LogRecord]):
+        lines = []
+        for record in records:
+            try:
+                lines.append(self.formatter.format(record) + '\n')
+            except Exception:
+                self.file.handleError(record)
+        data = ''.join(lines)
+
+        if self.file.stream is None:
+            self.file.stream = self.file._open()
+        if self.file.maxBytes and self.file.stream.tell() + len(data) >= self.file.maxBytes:
+            self.file.doRollover()
+
+        self.file.stream.write(data)
+        self.file.stream.flush()
+
+    def run(self):
+        running = True
+        while running:
+            records = [self.queue.get()]
+            while len(records) < LogWriter.BATCH:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            if None in records:
+                running = False
+                records = [record for record in records if record is not None]
+
+            if records:
+                self._write(records)
+
+        self.file.close()
+
+    def stop(self):
+        self.queue.put(None)
+        self.join()
+
+
+def start(filename: str, structured: bool = False, level: int = logging.INFO,
+          max_bytes: int = 10 * 1024 * 1024, backup_count: int = 5) -> LogWriter:
+    ''' Routes the root logger through the writer thread '''
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+
+    if structured:
+        formatter: logging.Formatter = StructuredFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s %(message)s')
+
+    directory = os.path.dirname(filename)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    writer = LogWriter(log_queue, filename, formatter, max_bytes, backup_count)
+    writer.start()
+
+    root = logging.getLogger()
+    root.addHandler(DeferredQueueHandler(log_queue))
+    root.setLevel(level)
+
+    return writer
@@ -0,0 +1,153 @@
+'''
+Order in which the units of a round have to be pressed.
+
+Every operation the game does per event (take the next unit, drop a unit
+that left, pick a random unit) is O(1), only building the order of a round
+sorts or shuffles the units once.
+'''
+
+from collections import deque
+import math
+import random
+from typing import Callable, Hashable, Iterable, Iterator, Optional
+
+
+class IndexedSet:
+    ''' Set with O(1) add, discard and uniform random choice '''
+
+    def __init__(self, items: Iterable[Hashable] = ()) -> None:
+        self._items: list[Hashable] = []
+        self._index: dict[Hashable, int] = {}
+        for item in items:
+            self.add(item)
+
+    def add(self, item: Hashable):
+        if item not in self._index:
+            self._index[item] = len(self._items)
+            self._items.append(item)
+
+    def discard(self, item: Hashable):
+        index = self._index.pop(item, None)
+        if index is None:
+            return
+
+        # Swap the last item into the hole
+        last = self._items.pop()
+        if index < len(self._items):
+            self._items[index] = last
+            self._index[last] = index
+
+    def choice(self, exclude: Optional[Hashable] = None) -> Hashable:
+        ''' Uniformly random item other than exclude, IndexError if there is none '''
+        if exclude in self._index:
+            if len(self._items) < 2:
+                raise IndexError("no item to choose from")
+            # Pick among all but one slot and skip over the excluded one
+            index = random.randrange(len(self._items) - 1)
+            if index >= self._index[exclude]:
+                index += 1
+            return self._items[index]
+
+        if not self._items:
+            raise IndexError("no item to choose from")
+        return self._items[random.randrange(len(self._items))]
+
+    def __contains__(self, item: object) -> bool:
+        return item in self._index
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __iter__(self) -> Iterator[Hashable]:
+        return iter(self._items)
+
+
+class Order:
+    '''
+    Queue of unit ids that also supports O(1) removal from the middle and
+    random choice. Removed ids stay in the deque until they reach the front.
+    '''
+
+    def __init__(self, unit_ids: Iterable[int] = ()) -> None:
+        self._queue: deque[int] = deque()
+        self._members = IndexedSet()
+        for unit_id in unit_ids:
+            if unit_id not in self._members:
+                self._queue.append(unit_id)
+                self._members.add(unit_id)
+
+    def popleft(self) -> int:
+        while True:
+            unit_id = self._queue.popleft()
+            if unit_id in self._members:
+                self._members.discard(unit_id)
+                return unit_id
+
+    def discard(self, unit_id: int):
+        self._members.discard(unit_id)
+        # Keep the tombstones from outgrowing the live ids
+        if len(self._queue) > 2 * len(self._members) + 16:
+            self._queue = deque(unit_id for unit_id in self._queue if unit_id in self._members)
+
+    def choice(self) -> int:
+        return self._members.choice()
+
+    def __contains__(self, unit_id: object) -> bool:
+        return unit_id in self._members
+
+    def __len__(self) -> int:
+        return len(self._members)
+
+    def __iter__(self) -> Iterator[int]:
+        return (unit_id for unit_id in self._queue if unit_id in self._members)
+
+    def __repr__(self) -> str:
+        return repr(list(self))
+
+
+# Sequencing strategies, from the distance of every unit to its order
+
+def shuffle(distances: dict[int, float]) -> list[int]:
+    unit_ids = list(distances)
+    random.shuffle(unit_ids)
+    return unit_ids
+
+
+def far_first(distances: dict[int, float]) -> list[int]:
+    return sorted(distances, key=distances.__getitem__, reverse=True)
+
+
+def near_first(distances: dict[int, float]) -> list[int]:
+    return sorted(distances, key=distances.__getitem__)
+
+
+def zigzag(distances: dict[int, float]) -> list[int]:
+    ''' Alternates between the farthest and nearest remaining units '''
+    ordered = near_first(distances)
+    unit_ids = []
+    low, high = 0, len(ordered) - 1
+    while low <= high:
+        unit_ids.append(ordered[high])
+        high -= 1
+        if low <= high:
+            unit_ids.append(ordered[low])
+            low += 1
+    return unit_ids
+
+
+def weighted(distances: dict[int, float]) -> list[int]:
+    ''' Random order in which farther units tend to come first '''
+    # Efraimidis-Spirakis keys, a weighted shuffle in one sort
+    def key(unit_id: int) -> float:
+        return math.log(1.0 - random.random()) / max(distances[unit_id], 1e-3)
+
+    return sorted(distances, key=key, reverse=True)
+
+
+STRATEGIES: dict[str, Callable[[dict[int, float]], list[int]]] = {
+    'shuffle': shuffle,
+    'far_first': far_first,
+    'near_first': near_first,
+    'zigzag': zigzag,
+    'weighted': weighted,
+}
@@ -0,0 +1,64 @@
+'''
+Outbound mailbox of a unit connection.
+
+Holds at most one pending frame per channel, a newer command for a channel
+replaces the one that has not been sent yet. A stalled link therefore never
+replays stale effects and the pending data stays bounded.
+'''
+
+import asyncio
+from typing import Hashable
+
+# One per controller on the unit
+CHANNELS = ('BUTTON_LED', 'MATRIX_LED', 'SOUND', 'DISTANCE')
+
+MAX_PENDING_BYTES = 16 * 1024
+
+
+class Mailbox:
+    def __init__(self, max_bytes: int = MAX_PENDING_BYTES) -> None:
+        self.max_bytes = max_bytes
+        self.pending: dict[Hashable, bytes] = {}
+        self.pending_bytes = 0
+
+        self.coalesced = 0
+        self.dropped = 0
+
+        self._ready = asyncio.Event()
+
+    def put(self, channel: Hashable, frame: bytes) -> bool:
+        ''' Returns False when the frame did not fit and was dropped '''
+        previous = self.pending.get(channel)
+        size = self.pending_bytes - (len(previous) if previous is not None else 0)
+
+        if size + len(frame) > self.max_bytes:
+            # The pending frame keeps its place
+            self.dropped += 1
+            return False
+
+        if previous is not None:
+            del self.pending[channel]
+            self.coalesced += 1
+
+        # Re-inserted so the frames go out in the order of their latest update
+        self.pending[channel] = frame
+        self.pending_bytes = size + len(frame)
+        self._ready.set()
+        return True
+
+    async def get(self) -> list[bytes]:
+        ''' Waits for and takes everything that is pending '''
+        while not self.pending:
+            self._ready.clear()
+            await self._ready.wait()
+
+        frames = list(self.pending.values())
+        self.pending.clear()
+        self.pending_bytes = 0
+        return frames
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    def __repr__(self) -> str:
+        return f"pending={len(self.pending)} bytes={self.pending_bytes} coalesced={self.coalesced} dropped={self.dropped}"
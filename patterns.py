@@ -0,0 +1,147 @@
+'''
+Lookup tables of the LED animations.
+
+Every named pattern is a fixed cycle of colors, so its table is computed
+once and the controllers only step through it: no Color objects and no
+HSV conversion per frame. The matrix additionally gets whole frames per
+strip length, which the framebuffer copies in one go.
+'''
+
+from array import array
+import colorsys
+import math
+from typing import Optional
+
+import framebuffer
+
+RGB = tuple[float, float, float]
+
+# Hue(deg=3.6) per colorscroll frame, one turn in 100 frames
+HUE_STEPS = 100
+SCROLL_INTERVAL = 0.04
+FLASH_INTERVAL = 0.1
+
+# One period of (1 + sin) / 2 for the proximity pulse
+SINE_STEPS = 256
+SINE = array('f', ((1 + math.sin(2 * math.pi * i / SINE_STEPS)) / 2 for i in range(SINE_STEPS)))
+
+# Players farther away than this get no pulse
+PULSE_RANGE = 2.0
+PULSE_PERIOD_NEAR = 0.3
+PULSE_PERIOD_FAR = 1.5
+# Fraction of the way to a new reading covered per frame
+PULSE_SMOOTHING = 0.15
+
+
+class Animation:
+    ''' Colors shown on every pixel one after another, 0 to 1 per channel '''
+
+    def __init__(self, colors: list[RGB], interval: float, loop: bool = True) -> None:
+        self.colors = tuple(colors)
+        self.packed = array('I', (framebuffer.pack(*(round(channel*255) for channel in color))
+                                  for color in self.colors))
+        self.interval = interval
+        self.loop = loop
+        self._frames: dict[int, tuple[array, ...]] = {}
+
+    def frames(self, length: int) -> tuple[array, ...]:
+        ''' Whole frames for a strip of length pixels '''
+        frames = self._frames.get(length)
+        if frames is None:
+            frames = self._frames[length] = tuple(array('I', [color]) * length
+                                                  for color in self.packed)
+        return frames
+
+    def frame_at(self, ticks: int, tick_interval: float) -> Optional[int]:
+        ''' Index of the frame due ticks into the animation, None once it ran out '''
+        if not self.colors:
+            return None
+        # A zero interval advances one frame per tick
+        index = int(ticks * tick_interval / max(self.interval, tick_interval) + 1e-9)
+        if self.loop:
+            return index % len(self.colors)
+        return index if index < len(self.colors) else None
+
+    def __len__(self) -> int:
+        return len(self.colors)
+
+
+_cache: dict[tuple, Animation] = {}
+
+
+def _cached(key: tuple, build) -> Animation:
+    animation = _cache.get(key)
+    if animation is None:
+        animation = _cache[key] = build()
+    return animation
+
+
+def solid(color: RGB) -> Animation:
+    return _cached(('solid', color), lambda: Animation([color], 0.0))
+
+
+def hue_cycle(start: RGB) -> Animation:
+    ''' A full turn of the hue wheel from start, keeping its lightness and saturation '''
+    hue, lightness, saturation = colorsys.rgb_to_hls(*start)
+
+    def build() -> Animation:
+        return Animation([colorsys.hls_to_rgb((hue + step / HUE_STEPS) % 1.0, lightness, saturation)
+                          for step in range(HUE_STEPS)], SCROLL_INTERVAL)
+
+    return _cached(('hue', round(hue, 4), round(lightness, 4), round(saturation, 4)), build)
+
+
+NAMED = {
+    'colorscroll': lambda: hue_cycle((0.0, 1.0, 0.0)),
+    'swipe_red': lambda: Animation([(1.0, 0.0, 0.0), (0.0, 0.0, 0.0)], FLASH_INTERVAL),
+    'flash_red': lambda: Animation([(1.0, 0.0, 0.0), (0.0, 0.0, 0.0)], FLASH_INTERVAL),
+    'flash_blue': lambda: Animation([(0.0, 0.0, 1.0), (0.0, 0.0, 0.0)], FLASH_INTERVAL),
+}
+
+
+def animation(pattern: str) -> Optional[Animation]:
+    ''' The table of a named pattern, None if it is unknown '''
+    if pattern in NAMED:
+        return _cached(('named', pattern), NAMED[pattern])
+    return None
+
+
+def red_levels() -> Animation:
+    ''' Every brightness of pure red, indexed by level '''
+    return _cached(('red',), lambda: Animation([(level / 255, 0.0, 0.0) for level in range(256)], 0.0))
+
+
+class ProximityPulse:
+    '''
+    Red pulse that gets faster and brighter the closer the player is.
+    Readings only move the targets, the pulse eases towards them frame by
+    frame, so it neither restarts nor jumps at sensor rate.
+    '''
+
+    def __init__(self, smoothing: float = PULSE_SMOOTHING) -> None:
+        self.smoothing = smoothing
+        self.brightness = 0.0
+        self.frequency = 1 / PULSE_PERIOD_FAR
+        self.target_brightness = 0.0
+        self.target_frequency = self.frequency
+        self.phase = 0.0
+
+    def update(self, distance: float):
+        nearness = max(0.0, min(1.0, (PULSE_RANGE - distance) / PULSE_RANGE))
+        self.target_brightness = nearness
+        self.target_frequency = 1 / (PULSE_PERIOD_FAR - (PULSE_PERIOD_FAR - PULSE_PERIOD_NEAR) * nearness)
+
+    def step(self, interval: float) -> int:
+        ''' Advances by interval seconds, the red level of the next frame '''
+        self.brightness += (self.target_brightness - self.brightness) * self.smoothing
+        self.frequency += (self.target_frequency - self.frequency) * self.smoothing
+        # Only the rate follows the reading, the phase carries on
+        self.phase = (self.phase + self.frequency * interval) % 1.0
+        return int(255 * self.brightness * SINE[int(self.phase * SINE_STEPS)])
+
+
+def preload(length: int):
+    ''' Builds the tables of the named patterns ahead of the first command '''
+    for pattern in NAMED:
+        animation(pattern).frames(length)
+    red_levels().frames(length)
@@ -0,0 +1,171 @@
+'''
+Wire format for the commands the gamemaster sends to the units.
+
+Units that advertise the "binary" feature in their REGISTER message receive
+fixed-layout struct frames, everyone else keeps receiving JSON. A unit can
+tell the two apart per frame because a binary frame starts with MAGIC, which
+can never be the first byte of a JSON document.
+'''
+
+from datetime import datetime
+from enum import IntEnum
+import json
+import struct
+from typing import Any, Optional, Union
+
+MAGIC = 0xB1
+
+AT_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+FEATURE_BINARY = 'binary'
+FEATURE_BATCH = 'batch'
+
+# Features this version of the protocol understands, advertised on REGISTER
+FEATURES = [FEATURE_BINARY, FEATURE_BATCH]
+
+Type = IntEnum('Type', ['BUTTON_LED', 'MATRIX_LED', 'SOUND', 'DISTANCE', 'DIE',
+                        'BATCH'])
+Value = IntEnum('Value', ['NONE', 'START', 'STOP', 'OFF'])
+Pattern = IntEnum('Pattern', ['NONE', 'RGB', 'colorscroll',
+                              'swipe_red', 'flash_red', 'flash_blue'])
+
+# magic, type, value, pattern, flags, at (epoch microseconds)
+HEADER = struct.Struct('!BBBBBq')
+# Set in flags when a TRACE id follows the header
+FLAG_TRACE = 0x01
+TRACE = struct.Struct('!I')
+RGB = struct.Struct('!BBB')
+DISTANCE = struct.Struct('!f')
+# magic, type, number of frames; every frame is then prefixed by its length
+BATCH = struct.Struct('!BBH')
+LENGTH = struct.Struct('!H')
+
+
+def _json_default(value: Any):
+    if isinstance(value, datetime):
+        return value.strftime(AT_FORMAT)
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def encode_json(data: dict[str, Any]) -> bytes:
+    return json.dumps(data, default=_json_default).encode()
+
+
+def encode_binary(data: dict[str, Any]) -> Optional[bytes]:
+    ''' Returns None when the command has no binary representation '''
+    try:
+        command_type = Type[data['type']]
+    except KeyError:
+        return None
+
+    at = data.get('at')
+    at_us = round(at.timestamp() * 1_000_000) if at is not None else 0
+
+    if command_type == Type.DISTANCE:
+        return HEADER.pack(MAGIC, command_type, Value.NONE, Pattern.NONE, 0, at_us) + \
+            DISTANCE.pack(data['value'])
+
+    value = Value[data.get('value', 'NONE')]
+
+    pattern: Union[str, tuple[int, int, int], None] = data.get('pattern')
+    if pattern is None:
+        header = HEADER.pack(MAGIC, command_type, value, Pattern.NONE, 0, at_us)
+        if command_type == Type.SOUND and 'filename' in data:
+            return header + data['filename'].encode()
+        return header
+    elif isinstance(pattern, str):
+        if pattern not in Pattern.__members__:
+            return None
+        return HEADER.pack(MAGIC, command_type, value, Pattern[pattern], 0, at_us)
+    else:
+        return HEADER.pack(MAGIC, command_type, value, Pattern.RGB, 0, at_us) + \
+            RGB.pack(*pattern)
+
+
+def encode(data: dict[str, Any], binary: bool) -> bytes:
+    if binary:
+        frame = encode_binary(data)
+        if frame is not None:
+            return frame
+    return encode_json(data)
+
+
+def encode_batch(frames: list[bytes], binary: bool) -> bytes:
+    ''' Packs already encoded frames into a single BATCH frame '''
+    if binary:
+        parts = [BATCH.pack(MAGIC, Type.BATCH, len(frames))]
+        for frame in frames:
+            parts.append(LENGTH.pack(len(frame)))
+            parts.append(frame)
+        return b''.join(parts)
+
+    # Every JSON frame is a complete object, so they can be spliced verbatim
+    return b'{"type": "BATCH", "commands": [' + b', '.join(frames) + b']}'
+
+
+def with_trace(frame: bytes, trace: int) -> bytes:
+    ''' Tags an already encoded command with the trace of the press it answers '''
+    if frame[:1] == bytes((MAGIC,)):
+        if frame[1] == Type.BATCH or frame[4] & FLAG_TRACE:
+            return frame
+        return frame[:4] + bytes((frame[4] | FLAG_TRACE,)) + frame[5:HEADER.size] + \
+            TRACE.pack(trace) + frame[HEADER.size:]
+    return b'{"trace": %d, ' % trace + frame[1:]
+
+
+def decode_binary(frame: bytes) -> dict[str, Any]:
+    if frame[1] == Type.BATCH:
+        _, _, count = BATCH.unpack_from(frame)
+        offset = BATCH.size
+        commands = []
+        for _ in range(count):
+            (length,) = LENGTH.unpack_from(frame, offset)
+            offset += LENGTH.size
+            commands.append(decode(frame[offset:offset + length]))
+            offset += length
+        return {'type': 'BATCH', 'commands': commands}
+
+    _, command_type, value, pattern, flags, at_us = HEADER.unpack_from(frame)
+    payload = frame[HEADER.size:]
+
+    message: dict[str, Any] = {'type': Type(command_type).name, 'at': at_us}
+
+    if flags & FLAG_TRACE:
+        (message['trace'],) = TRACE.unpack_from(payload)
+        payload = payload[TRACE.size:]
+
+    if command_type == Type.DISTANCE:
+        message['value'] = DISTANCE.unpack(payload)[0]
+        return message
+
+    message['value'] = Value(value).name
+
+    if pattern == Pattern.RGB:
+        message['pattern'] = list(RGB.unpack(payload))
+    elif pattern != Pattern.NONE:
+        message['pattern'] = Pattern(pattern).name
+    elif command_type == Type.SOUND and payload:
+        message['filename'] = payload.decode()
+
+    return message
+
+
+def decode(frame: Union[str, bytes]) -> dict[str, Any]:
+    if isinstance(frame, bytes) and frame[:1] == bytes((MAGIC,)):
+        return decode_binary(frame)
+    return json.loads(frame)
+
+
+def decode_all(frame: Union[str, bytes]) -> list[dict[str, Any]]:
+    ''' Decodes a frame into the list of commands it carries '''
+    message = decode(frame)
+    if message['type'] == 'BATCH':
+        return message['commands']
+    return [message]
+
+
+def at_to_epoch(at: Union[int, str]) -> float:
+    ''' Converts the 'at' field of either encoding to epoch seconds '''
+    if isinstance(at, int):
+        return at / 1_000_000
+    return datetime.strptime(at, AT_FORMAT).timestamp()
@@ -0,0 +1,81 @@
+'''
+Dedicated thread that owns the LED strip.
+
+show() is a blocking DMA transfer in rpi_ws281x, so the event loop only
+hands frames over and never waits for the strip. The handoff is a single
+slot: a frame that was not shown yet is replaced by the newer one, the
+strip always gets the latest frame and a slow transfer never queues up.
+'''
+
+import asyncio
+from array import array
+from collections import deque
+import threading
+from typing import Optional
+
+import framebuffer
+
+JOIN_TIMEOUT = 1.0
+
+
+class RenderThread:
+    def __init__(self, strip) -> None:
+        self.strip = strip
+        # append() and popleft() are atomic, a full slot is simply overwritten
+        self._slot: deque[tuple[int, array]] = deque(maxlen=1)
+        self._wake = threading.Event()
+        self._closing = False
+        self._thread = threading.Thread(target=self._run, name='render', daemon=True)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+        # Events to set once the frame with that sequence number or a later one is shown
+        self._waiters: list[tuple[int, asyncio.Event]] = []
+        self.submitted = 0
+        self.shown = 0
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._thread.start()
+
+    def submit(self, pixels: array, presented: Optional[asyncio.Event] = None):
+        ''' Hands a frame over without blocking, presented is set once it is lit '''
+        self.submitted += 1
+        if presented is not None:
+            self._waiters.append((self.submitted, presented))
+        self._slot.append((self.submitted, array('I', pixels)))
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            try:
+                sequence, pixels = self._slot.popleft()
+            except IndexError:
+                pass
+            else:
+                framebuffer.write(self.strip, pixels)
+                self.strip.show()
+                self.shown += 1
+                self._loop.call_soon_threadsafe(self._presented, sequence)
+
+            if self._closing and not self._slot:
+                break
+
+    def _presented(self, sequence: int):
+        waiting = []
+        for waiter in self._waiters:
+            if waiter[0] <= sequence:
+                waiter[1].set()
+            else:
+                waiting.append(waiter)
+        self._waiters = waiting
+
+    async def close(self):
+        ''' Shows the last frame handed over and stops the thread '''
+        self._closing = True
+        self._wake.set()
+        if self._thread.is_alive():
+            await asyncio.to_thread(self._thread.join, JOIN_TIMEOUT)
+        print(f"Render thread: {self.submitted} frames submitted, "
+              f"{self.submitted - self.shown} replaced before they were shown")
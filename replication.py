@@ -0,0 +1,105 @@
+'''
+Hot-standby replication of the game state to follower gamemasters.
+
+The active gamemaster diffs the replicable state of every room against what
+it sent last and pushes only the changed fields. A follower that connects
+first gets a snapshot of all rooms, then the deltas:
+
+    {"type": "SNAPSHOT", "rooms": {room: state}}
+    {"type": "DELTA", "room": room, "changes": {field: value}}
+    {"type": "CLOSED", "room": room}
+'''
+
+import asyncio
+import json
+import logging
+import ssl
+from typing import Any, Optional
+
+import websockets
+from websockets.client import connect
+from websockets.exceptions import WebSocketException
+
+_logger = logging.getLogger("gamemaster")
+
+REPLICATION_INTERVAL = 0.05
+
+
+def diff(previous: dict[str, Any], current: dict[str, Any]) -> dict[str, Any]:
+    return {key: value for key, value in current.items()
+            if key not in previous or previous[key] != value}
+
+
+class Replicator:
+    ''' Streams the state of every room to the followers '''
+
+    def __init__(self, rooms) -> None:
+        self.rooms = rooms
+        self.followers: set = set()
+        self.sent: dict[str, dict[str, Any]] = {}
+
+    def deltas(self) -> list[dict[str, Any]]:
+        current = {room: game.replica() for room, game in self.rooms.games.items()}
+
+        messages = []
+        for room, state in current.items():
+            changes = diff(self.sent.get(room, {}), state)
+            if changes:
+                messages.append({'type': 'DELTA', 'room': room, 'changes': changes})
+        for room in self.sent.keys() - current.keys():
+            messages.append({'type': 'CLOSED', 'room': room})
+
+        self.sent = current
+        return messages
+
+    def flush(self):
+        messages = self.deltas()
+        if self.followers:
+            for message in messages:
+                websockets.broadcast(self.followers, json.dumps(message))
+
+    async def run(self, interval: float = REPLICATION_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            self.flush()
+
+    async def serve(self, websocket):
+        # Nothing yields between the flush and joining the followers, so the
+        # snapshot and the following deltas line up
+        self.flush()
+        websockets.broadcast((websocket,), json.dumps({'type': 'SNAPSHOT', 'rooms': self.sent}))
+        self.followers.add(websocket)
+        _logger.info("Follower connected for replication",
+                     extra={'event': 'FOLLOWER_OPEN', 'followers': len(self.followers)})
+        try:
+            await websocket.wait_closed()
+        finally:
+            self.followers.discard(websocket)
+
+
+class Replica:
+    ''' The follower side, the latest known state of every room '''
+
+    def __init__(self) -> None:
+        self.rooms: dict[str, dict[str, Any]] = {}
+
+    def apply(self, message: dict[str, Any]):
+        if message['type'] == 'SNAPSHOT':
+            self.rooms = message['rooms']
+        elif message['type'] == 'DELTA':
+            self.rooms.setdefault(message['room'], {}).update(message['changes'])
+        elif message['type'] == 'CLOSED':
+            self.rooms.pop(message['room'], None)
+
+    async def receive(self, url: str, ssl: ssl.SSLContext):
+        try:
+            async with connect(f"wss://{url}:8002/replicate", ssl=ssl, ping_interval=None) as socket:
+                async for msg in socket:
+                    self.apply(json.loads(msg))
+        except (OSError, WebSocketException) as e:
+            _logger.info("Replication from %s stopped: %r", url, e,
+                         extra={'event': 'REPLICATION_LOST', 'peer': url})
+
+    def take(self) -> Optional[dict[str, dict[str, Any]]]:
+        rooms, self.rooms = self.rooms, {}
+        return rooms or None
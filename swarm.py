@@ -0,0 +1,389 @@
+'''
+Load generator that simulates a swarm of units against a gamemaster.
+
+Every simulated unit opens its own websocket to the unit port, speaks the
+same protocol as unit.py and presses its button either on a random schedule
+or following a script. At the end the press-to-command latency, the fan-out
+spread of broadcast effects and the gamemaster CPU usage are reported.
+
+    python swarm.py --make-ca certs --host localhost
+    python gamemaster.py -u localhost -p 1 -g localhost \\
+        -k certs/gamemaster.key -r certs/gamemaster.crt -ca certs/ca.crt
+    python swarm.py -ca certs/ca.crt -u localhost -n 200 --pid <gamemaster pid>
+    python swarm.py -ca certs/ca.crt -u localhost --reconnects 50
+'''
+
+import argparse
+import asyncio
+from collections import defaultdict
+import json
+import os
+import random
+import ssl
+import subprocess
+import sys
+import time
+from typing import Optional
+
+from websockets.client import connect
+from websockets.client import WebSocketClientProtocol
+from websockets.exceptions import ConnectionClosed, WebSocketException
+
+import discovery
+import protocol
+import tlssession
+import tracing
+
+# Presses without a tagged reply within this window commanded nothing
+PRESS_WINDOW = 2.0
+
+
+def percentiles(samples: list[float]) -> str:
+    if not samples:
+        return "no samples"
+
+    samples = sorted(samples)
+
+    def at(p: float) -> float:
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100))] * 1000
+
+    return f"n={len(samples)} p50={at(50):.2f}ms p95={at(95):.2f}ms p99={at(99):.2f}ms max={samples[-1] * 1000:.2f}ms"
+
+
+class SimulatedUnit:
+    def __init__(self, unit_id: int, features: list[str], room: str) -> None:
+        self.unit_id = unit_id
+        self.features = features
+        self.room = room
+
+        self.socket: Optional[WebSocketClientProtocol] = None
+        self.tracer = tracing.Tracer()
+        # trace id -> perf_counter of presses waiting for their commands
+        self.pressed: dict[int, float] = {}
+
+        self.press_latencies: list[float] = []
+        self.unanswered = 0
+        # (type, value, at) -> receive time, to line up broadcasts across units
+        self.received: dict[tuple, float] = {}
+        self.commands = 0
+
+    async def send(self, data: dict):
+        assert self.socket is not None
+        await self.socket.send(json.dumps(data).encode())
+
+    async def press(self):
+        now = time.perf_counter()
+        for trace, pressed_at in list(self.pressed.items()):
+            if now - pressed_at > PRESS_WINDOW:
+                del self.pressed[trace]
+                self.unanswered += 1
+
+        message = self.tracer.pressed(time.monotonic())
+        self.pressed[message['trace']] = now
+        await self.send(message)
+
+    async def release(self):
+        await self.send({'type': "BUTTON_RELEASED"})
+
+    async def update_distance(self, distance: float):
+        await self.send({'type': "DISTANCE_UPDATE", 'distance': distance})
+
+    async def receive(self):
+        assert self.socket is not None
+        async for msg in self.socket:
+            received = time.perf_counter()
+
+            arrived = time.monotonic()
+            for message in protocol.decode_all(msg):
+                self.commands += 1
+                if 'trace' in message:
+                    # The first command tagged with a press answers it
+                    pressed_at = self.pressed.pop(message['trace'], None)
+                    if pressed_at is not None:
+                        self.press_latencies.append(received - pressed_at)
+
+                    # Rendered on arrival, so the gamemaster sees the network hops
+                    message['received'] = arrived
+                    await self.tracer.rendered(message, arrived, arrived)
+                    await self.send(self.tracer.acks.get_nowait())
+                if 'at' in message:
+                    key = (message['type'], str(message.get('value')), message['at'])
+                    self.received.setdefault(key, received)
+
+    async def run(self, uri: str, ssl_context: ssl.SSLContext, ready: asyncio.Event):
+        async with connect(uri, ssl=ssl_context) as socket:
+            self.socket = socket
+            await self.send({'type': "REGISTER", 'id': f"{self.unit_id:x}",
+                             'features': self.features, 'room': self.room})
+            ready.set()
+            try:
+                await self.receive()
+            except ConnectionClosed:
+                pass
+
+    async def unregister(self):
+        if self.socket is not None and not self.socket.closed:
+            await self.send({'type': "UNREGISTER"})
+            await self.socket.close()
+
+
+async def registration(task: asyncio.Task, ready: asyncio.Event) -> Optional[BaseException]:
+    ''' None once the unit registered, why it did not if its task ended first '''
+    waiter = asyncio.create_task(ready.wait())
+    await asyncio.wait([waiter, task], return_when=asyncio.FIRST_COMPLETED)
+    waiter.cancel()
+    if ready.is_set():
+        return None
+    return task.exception() or ConnectionClosed(None, None)
+
+
+async def random_schedule(unit: SimulatedUnit, press_interval: float, hold: float,
+                          distance_interval: float, stop: asyncio.Event):
+    next_distance = time.perf_counter()
+    while not stop.is_set():
+        await asyncio.sleep(random.expovariate(1 / press_interval))
+        if stop.is_set():
+            break
+
+        await unit.press()
+        await asyncio.sleep(hold)
+        await unit.release()
+
+        if distance_interval and time.perf_counter() >= next_distance:
+            await unit.update_distance(random.uniform(1.0, 10.0))
+            next_distance = time.perf_counter() + distance_interval
+
+
+async def scripted_schedule(units: list[SimulatedUnit], script: str, stop: asyncio.Event):
+    ''' Replays lines of {"t": seconds, "unit": index, "type": event} '''
+    with open(script) as events:
+        steps = [json.loads(line) for line in events if line.strip()]
+
+    start = time.perf_counter()
+    for step in sorted(steps, key=lambda step: step['t']):
+        delay = start + step['t'] - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if stop.is_set():
+            break
+
+        unit = units[step['unit'] % len(units)]
+        if step['type'] == 'BUTTON_PRESSED':
+            await unit.press()
+        elif step['type'] == 'BUTTON_RELEASED':
+            await unit.release()
+        elif step['type'] == 'DISTANCE_UPDATE':
+            await unit.update_distance(step['distance'])
+        elif step['type'] == 'UNREGISTER':
+            await unit.unregister()
+
+
+def cpu_seconds(pid: int) -> float:
+    with open(f"/proc/{pid}/stat") as stat:
+        fields = stat.read().rsplit(')', 1)[1].split()
+    # utime and stime, fields 14 and 15 of proc(5)
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+async def sample_cpu(pid: int, samples: list[float], stop: asyncio.Event, interval: float = 1.0):
+    previous = cpu_seconds(pid)
+    while not stop.is_set():
+        await asyncio.sleep(interval)
+        current = cpu_seconds(pid)
+        samples.append((current - previous) / interval)
+        previous = current
+
+
+def fanout_spreads(units: list[SimulatedUnit]) -> list[float]:
+    arrivals: dict[tuple, list[float]] = defaultdict(list)
+    for unit in units:
+        for key, received in unit.received.items():
+            arrivals[key].append(received)
+
+    return [max(times) - min(times) for times in arrivals.values() if len(times) > 1]
+
+
+async def reconnect(url: str, ssl_context: ssl.SSLContext, legacy: bool) -> float:
+    ''' Seconds from a lost connection to the first command after REGISTER '''
+    start = time.perf_counter()
+    if legacy:
+        # Discovery probe on 8002, then a second TLS handshake on 8001
+        await discovery.probe(url, ssl_context)
+        uri = f"wss://{url}:8001"
+    else:
+        uri = f"wss://{url}:8002/units"
+
+    async with connect(uri, ssl=ssl_context) as socket:
+        await socket.send(json.dumps({'type': "REGISTER", 'id': f"{random.getrandbits(48):x}"}).encode())
+        await socket.recv()
+        elapsed = time.perf_counter() - start
+        await socket.send(json.dumps({'type': "UNREGISTER"}).encode())
+
+    return elapsed
+
+
+async def measure_reconnects(url: str, ca_certificate: str, count: int):
+    for legacy in (True, False):
+        for resume in (False, True):
+            if resume:
+                ssl_context: ssl.SSLContext = tlssession.ResumingSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            else:
+                ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            ssl_context.load_verify_locations(ca_certificate)
+
+            name = "probe + port 8001" if legacy else "port 8002 /units"
+            name += ", resumed" if resume else ", full handshake"
+
+            samples = []
+            try:
+                # One extra round so the resumed runs start with a session
+                for _ in range(count + 1):
+                    samples.append(await reconnect(url, ssl_context, legacy))
+            except (OSError, WebSocketException) as e:
+                print(f"reconnect ({name}): failed with {e!r}")
+                continue
+            print(f"reconnect ({name}):", percentiles(samples[1:]))
+
+
+def make_ca(directory: str, hosts: list[str]):
+    ''' Creates a throwaway CA and a gamemaster certificate signed by it '''
+    os.makedirs(directory, exist_ok=True)
+
+    def path(name: str) -> str:
+        return os.path.join(directory, name)
+
+    def openssl(*args: str):
+        subprocess.run(['openssl', *args], check=True, capture_output=True)
+
+    openssl('req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '30',
+            '-subj', '/CN=swarm-ca', '-keyout', path('ca.key'), '-out', path('ca.crt'))
+    openssl('req', '-newkey', 'rsa:2048', '-nodes', '-subj', f'/CN={hosts[0]}',
+            '-keyout', path('gamemaster.key'), '-out', path('gamemaster.csr'))
+
+    with open(path('san.ext'), 'w') as extensions:
+        names = [f"IP:{host}" if host.replace('.', '').isdigit() else f"DNS:{host}"
+                 for host in hosts]
+        extensions.write(f"subjectAltName={','.join(names)}\n")
+
+    openssl('x509', '-req', '-days', '30', '-in', path('gamemaster.csr'),
+            '-CA', path('ca.crt'), '-CAkey', path('ca.key'), '-CAcreateserial',
+            '-extfile', path('san.ext'), '-out', path('gamemaster.crt'))
+
+    print(f"CA and gamemaster certificate written to {directory}")
+
+
+def parse_arguments(args: list[str]):
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--make-ca', metavar='directory',
+                        help='Create a self-signed CA and gamemaster certificate and exit')
+    parser.add_argument('--host', action='append', default=[],
+                        help='Host names for the generated certificate')
+
+    parser.add_argument('-ca', '--ca-certificate',
+                        metavar='path',
+                        help='The path to the CA certificate')
+    parser.add_argument('-u', '--url', default='localhost')
+    parser.add_argument('--legacy', action='store_true',
+                        help='Attach on port 8001 like older units, needs gamemaster --legacy-port')
+
+    parser.add_argument('-n', '--units', type=int, default=50)
+    parser.add_argument('--rooms', type=int, default=1,
+                        help='Spread the units over this many game rooms')
+    parser.add_argument('-d', '--duration', type=float, default=60)
+    parser.add_argument('--press-interval', type=float, default=5,
+                        help='Mean seconds between presses of a unit')
+    parser.add_argument('--hold', type=float, default=0.3,
+                        help='Seconds a button is held down')
+    parser.add_argument('--distance-interval', type=float, default=0,
+                        help='Seconds between DISTANCE_UPDATE messages, 0 disables')
+    parser.add_argument('--script', metavar='path',
+                        help='JSON lines of events to replay instead of random presses')
+    parser.add_argument('--json', action='store_true',
+                        help='Do not advertise any protocol features')
+    parser.add_argument('--pid', type=int,
+                        help='Gamemaster process id to sample CPU usage from')
+    parser.add_argument('--reconnects', type=int, default=0,
+                        help='Measure this many unit reconnects instead of running the swarm')
+
+    return parser.parse_args(args)
+
+
+async def main(args: list[str]):
+    options = parse_arguments(args)
+
+    if options.make_ca:
+        make_ca(options.make_ca, options.host or ['localhost', '127.0.0.1'])
+        return
+
+    if options.ca_certificate is None:
+        sys.exit("--ca-certificate is required")
+
+    ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    ssl_context.load_verify_locations(options.ca_certificate)
+
+    if options.reconnects:
+        await measure_reconnects(options.url, options.ca_certificate, options.reconnects)
+        return
+
+    features = [] if options.json else protocol.FEATURES
+    base_id = random.getrandbits(32) << 16
+    units = [SimulatedUnit(base_id + i, features, f"room{i % options.rooms}")
+             for i in range(options.units)]
+
+    uri = f"wss://{options.url}:8001" if options.legacy else f"wss://{options.url}:8002/units"
+    stop = asyncio.Event()
+
+    readies = [asyncio.Event() for _ in units]
+    connect_start = time.perf_counter()
+    unit_tasks = [asyncio.create_task(unit.run(uri, ssl_context, ready))
+                  for unit, ready in zip(units, readies)]
+    failures = await asyncio.gather(*(registration(task, ready)
+                                      for task, ready in zip(unit_tasks, readies)))
+    failed = [failure for failure in failures if failure is not None]
+    if failed:
+        for task in unit_tasks:
+            task.cancel()
+        await asyncio.gather(*unit_tasks, return_exceptions=True)
+        for failure in failed[:5]:
+            print("Connect failed:", repr(failure))
+        sys.exit(f"{len(failed)} of {len(units)} units failed to connect to {uri}")
+    print(f"{len(units)} units registered in {time.perf_counter() - connect_start:.2f}s")
+
+    cpu_samples: list[float] = []
+    background = []
+    if options.pid:
+        background.append(asyncio.create_task(
+            sample_cpu(options.pid, cpu_samples, stop)))
+
+    if options.script:
+        background.append(asyncio.create_task(
+            scripted_schedule(units, options.script, stop)))
+    else:
+        background.extend(asyncio.create_task(
+            random_schedule(unit, options.press_interval, options.hold,
+                            options.distance_interval, stop))
+            for unit in units)
+
+    await asyncio.sleep(options.duration)
+    stop.set()
+
+    for task in background:
+        task.cancel()
+    await asyncio.gather(*background, return_exceptions=True)
+
+    await asyncio.gather(*(unit.unregister() for unit in units), return_exceptions=True)
+    await asyncio.gather(*unit_tasks, return_exceptions=True)
+
+    print("press to command:", percentiles(
+        [latency for unit in units for latency in unit.press_latencies]))
+    print("presses without commands:", sum(unit.unanswered + len(unit.pressed) for unit in units))
+    print("broadcast fan-out:", percentiles(fanout_spreads(units)))
+    print("commands received:", sum(unit.commands for unit in units))
+    if cpu_samples:
+        print(f"gamemaster cpu: mean={100 * sum(cpu_samples) / len(cpu_samples):.1f}% "
+              f"max={100 * max(cpu_samples):.1f}%")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(sys.argv[1:]))
@@ -0,0 +1,50 @@
+'''
+TLS session resumption for client connections.
+
+asyncio creates the TLS object of every connection through
+SSLContext.wrap_bio() and offers no way to pass a session, so the context
+itself remembers the last session of every host and hands it to the next
+connection. A resumed handshake skips the certificate exchange and
+signature, which is most of the cost on a small board.
+'''
+
+import ssl
+from typing import Optional
+
+
+class ResumingSSLContext(ssl.SSLContext):
+    def __init__(self, protocol: int) -> None:
+        self._sessions: dict[Optional[str], ssl.SSLSession] = {}
+        # Latest connection of every host, its session is only known once
+        # the handshake is done and the tickets arrived
+        self._latest: dict[Optional[str], ssl.SSLObject] = {}
+
+        self.handshakes = 0
+        self.resumed = 0
+
+    def _collect(self, server_hostname: Optional[str]):
+        latest = self._latest.pop(server_hostname, None)
+        if latest is None or latest.session is None:
+            return
+
+        self.handshakes += 1
+        if latest.session_reused:
+            self.resumed += 1
+        self._sessions[server_hostname] = latest.session
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None,
+                 session=None):
+        if server_side:
+            return super().wrap_bio(incoming, outgoing, server_side, server_hostname, session)
+
+        self._collect(server_hostname)
+        if session is None:
+            session = self._sessions.get(server_hostname)
+
+        sslobj = super().wrap_bio(incoming, outgoing, server_side, server_hostname, session)
+        self._latest[server_hostname] = sslobj
+        return sslobj
+
+    def forget(self, server_hostname: Optional[str]):
+        self._sessions.pop(server_hostname, None)
+        self._latest.pop(server_hostname, None)
@@ -0,0 +1,111 @@
+'''
+Press-to-light tracing.
+
+A unit numbers every press and the gamemaster tags the commands the press
+caused with that trace id. Once a tagged command is on the LEDs or the
+speaker, the unit acknowledges it:
+
+    {"type": "BUTTON_PRESSED", "trace": 7, "callback": 0.0004}
+    {"type": "RENDERED", "trace": 7, "channel": "MATRIX_LED", "elapsed": 0.031,
+     "hops": {"dispatch": 0.0002, "scheduled": 0.02, "render": 0.004}}
+
+Monotonic clocks of two machines can not be compared, so each side only
+reports durations it measured itself and the network is what is left of the
+round trip from the button edge to the rendered command.
+'''
+
+import asyncio
+from collections import OrderedDict
+import time
+from typing import Any, Optional
+
+# In the order they happen
+HOPS = ('callback', 'network', 'game', 'queue', 'dispatch', 'scheduled', 'render')
+# The hops a RENDERED acknowledgement reports, measured by the unit alone
+UNIT_HOPS = ('dispatch', 'scheduled', 'render')
+
+# Presses in flight that are remembered for their acknowledgements
+MAX_TRACES = 32
+
+
+class Tracer:
+    ''' The unit side, numbers presses and acknowledges rendered commands '''
+
+    def __init__(self) -> None:
+        self._next_trace = 0
+        self._edges: OrderedDict[int, float] = OrderedDict()
+        self.acks: asyncio.Queue[dict[str, Any]] = asyncio.Queue()
+
+    def pressed(self, edge: float) -> dict[str, Any]:
+        ''' The BUTTON_PRESSED message of a press seen at monotonic time edge '''
+        self._next_trace = (self._next_trace + 1) & 0xFFFFFFFF
+        self._edges[self._next_trace] = edge
+        while len(self._edges) > MAX_TRACES:
+            self._edges.popitem(last=False)
+
+        return {'type': 'BUTTON_PRESSED', 'trace': self._next_trace,
+                'callback': time.monotonic() - edge}
+
+    async def rendered(self, command: dict[str, Any], dispatched: float, started: float,
+                       presented: Optional[asyncio.Event] = None):
+        ''' Acknowledges a traced command once its output is presented '''
+        if 'trace' not in command:
+            return
+
+        if presented is not None:
+            await presented.wait()
+        else:
+            await asyncio.sleep(0)
+        rendered = time.monotonic()
+
+        ack: dict[str, Any] = {
+            'type': 'RENDERED', 'trace': command['trace'], 'channel': command['type'],
+            'hops': {'dispatch': dispatched - command['received'],
+                     'scheduled': started - dispatched,
+                     'render': rendered - started}}
+        edge = self._edges.get(command['trace'])
+        if edge is not None:
+            ack['elapsed'] = rendered - edge
+        self.acks.put_nowait(ack)
+
+
+class Trace:
+    ''' The gamemaster side of one press, perf_counter timestamps '''
+    __slots__ = ('trace_id', 'callback', 'received', 'dispatched', 'sent', 'acknowledged')
+
+    def __init__(self, trace_id: Optional[int], callback: Optional[float], received: float) -> None:
+        self.trace_id = trace_id
+        self.callback = callback
+        self.received = received
+        self.dispatched = received
+        self.sent = received
+        self.acknowledged = False
+
+    def hops(self, ack: dict[str, Any]) -> dict[str, float]:
+        ''' Every hop of the press as far as the acknowledgement allows '''
+        hops = {'game': self.dispatched - self.received, 'queue': self.sent - self.dispatched}
+        if self.callback is not None:
+            hops['callback'] = self.callback
+        hops.update(ack['hops'])
+
+        if 'elapsed' in ack and self.callback is not None:
+            hops['network'] = max(0.0, ack['elapsed'] - sum(hops.values()))
+        return hops
+
+
+class Traces:
+    ''' Presses of one unit that were sent and wait for their acknowledgements '''
+
+    def __init__(self, size: int = MAX_TRACES) -> None:
+        self.size = size
+        self._traces: OrderedDict[int, Trace] = OrderedDict()
+
+    def add(self, trace: Trace):
+        if trace.trace_id is None:
+            return
+        self._traces[trace.trace_id] = trace
+        while len(self._traces) > self.size:
+            self._traces.popitem(last=False)
+
+    def get(self, trace_id: int) -> Optional[Trace]:
+        return self._traces.get(trace_id)
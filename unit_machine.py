@@ -8,22 +8,30 @@ import argparse
 import asyncio
 from asyncio import PriorityQueue, Event
 import http
-from itertools import cycle
 import json
 import re
 import signal
 import ssl
+import time
 import sys
-import requests
 import websockets
 sys.path.append('/home/pi/Team_Art_Sof')
 import sensor_lib
+import protocol
+import clocksync
+from compositor import Compositor, Layer
+import framebuffer
+import patterns
+from renderthread import RenderThread
+import discovery
+import tlssession
+import tracing
 from websockets.client import connect
 from websockets.client import WebSocketClientProtocol
-from websockets.exceptions import ConnectionClosedError
+from websockets.exceptions import ConnectionClosedError, InvalidHandshake
 
 from gpiozero import Button, RGBLED
-from colorzero import Color, Hue
+from colorzero import Color
 
 from rpi_ws281x import PixelStrip
 
@@ -39,35 +47,43 @@ LED_PIN = 21        # GPIO pin connected to the pixels (21 uses PCM).
 RECHECK_INTERVAL = 10
 
 
-class Controller(ABC):
+class Controller(Layer, ABC):
     STATES = IntEnum('States', ['IDLE', 'RUNNING'])
 
-    def __init__(self) -> None:
+    def __init__(self, compositor: Compositor) -> None:
         self.state = Controller.STATES.IDLE
-        self.task: Optional[asyncio.Task] = None
+        self.compositor = compositor
+        # Tick the current command started on
+        self.started = 0
+        # Set once the output of the current command is lit
+        self.presented = asyncio.Event()
+        compositor.add(self)
 
     @abstractmethod
-    async def _run(self, *args):
+    def _start(self, *args):
+        raise NotImplementedError(
+            "You have to override this function in the derivative")
+
+    @abstractmethod
+    def _render(self, ticks: int):
+        ''' Called on every tick while running, ticks counted from the first one '''
         raise NotImplementedError(
             "You have to override this function in the derivative")
 
     async def start(self, *args):
         await self.stop()
         self.state = Controller.STATES.RUNNING
-
-        self.task = asyncio.create_task(self._run(*args))
+        self.started = self.compositor.tick
+        self.presented = asyncio.Event()
+        self._start(*args)
 
     async def stop(self) -> None:
-        if self.task:
-            try:
-                self.task.cancel()
-                await self.task
-
-                self.task = None
-            except asyncio.CancelledError:
-                pass
-
         self.state = Controller.STATES.IDLE
+        self.presented.set()
+
+    def render(self, tick: int):
+        if self.state == Controller.STATES.RUNNING:
+            self._render(tick - self.started - 1)
 
     @abstractmethod
     async def off(self):
@@ -78,109 +94,175 @@ class Controller(ABC):
 
     async def __aexit__(self, type, value, traceback):
         await self.off()
+        self.compositor.remove(self)
+
+
+class AnimationController(Controller):
+    ''' Plays animation tables, the output is only touched when the frame changes '''
 
+    def __init__(self, compositor: Compositor) -> None:
+        super().__init__(compositor)
+        self.animation: Optional[patterns.Animation] = None
+        self.shown: Optional[int] = None
 
-class ButtonLEDController(Controller):
-    def __init__(self, led: RGBLED):
-        super().__init__()
+    @abstractmethod
+    def _animation(self, pattern) -> Optional[patterns.Animation]:
+        raise NotImplementedError(
+            "You have to override this function in the derivative")
+
+    @abstractmethod
+    def _output(self, animation: patterns.Animation, index: int):
+        ''' Shows a frame and sets presented once it is lit '''
+        raise NotImplementedError(
+            "You have to override this function in the derivative")
+
+    def _start(self, pattern):
+        self.animation = self._animation(pattern)
+        self.shown = None
+
+    def _render(self, ticks: int):
+        index = None
+        if self.animation is not None:
+            index = self.animation.frame_at(ticks, self.compositor.interval)
+
+        if index is None:
+            # Ran out, the last frame stays up
+            self.state = Controller.STATES.IDLE
+            self.presented.set()
+        elif index != self.shown:
+            self._output(self.animation, index)
+            self.shown = index
+
+
+class ButtonLEDController(AnimationController):
+    def __init__(self, led: RGBLED, compositor: Compositor):
+        super().__init__(compositor)
         self.i = 0
         self.led = led
 
-    async def _run(self, *args, **kwargs):
-        if isinstance(args[0], list):
-            pattern = tuple(args[0][i]/255 for i in range(3))
-            self.led.color = pattern
-        elif args[0] == 'colorscroll':
+    def _animation(self, pattern) -> Optional[patterns.Animation]:
+        if isinstance(pattern, list):
+            return patterns.solid(tuple(pattern[i]/255 for i in range(3)))
+        elif pattern == 'colorscroll':
             if self.led.color in (Color(0, 0, 0), Color(1, 1, 1)):
                 self.led.color = Color(1, 0, 0)
-            color = Color(self.led.color)
-            while self.state == Controller.STATES.RUNNING:
-                self.led.color = color
+            return patterns.hue_cycle(tuple(self.led.color))
+        return patterns.animation(pattern)
 
-                color += Hue(deg=3.6)
-                await asyncio.sleep(0.04)
-        elif args[0] == 'flash_red':
-            self.led.blink(0.1, 0.1, on_color=(1, 0, 0))
-        elif args[0] == 'flash_blue':
-            self.led.blink(0.1, 0.1, on_color=(0, 0, 1))
+    def _output(self, animation: patterns.Animation, index: int):
+        self.led.color = animation.colors[index]
+        self.presented.set()
 
     async def off(self):
         await self.stop()
         self.led.off()
 
 
-class MatrixLEDController(Controller):
-    def __init__(self, matrix: PixelStrip):
-        super().__init__()
+class MatrixLEDController(AnimationController):
+    def __init__(self, matrix: PixelStrip, compositor: Compositor):
+        super().__init__(compositor)
         self.matrix = matrix
+        self.frame = framebuffer.FrameBuffer(matrix.numPixels())
+        # Owns the strip from here on, show() never runs on the event loop
+        self.renderer = RenderThread(matrix)
+        self.renderer.start()
+
+        self.pulse = patterns.ProximityPulse()
+        # Set while the proximity pulse plays instead of an animation table
+        self.live: Optional[patterns.ProximityPulse] = None
+
+    async def start(self, *args):
+        if isinstance(args[0], str) and args[0].startswith('pulse_'):
+            # Readings come in at sensor rate, a running pulse only takes the new
+            # distance and a running game pattern keeps the matrix
+            self.pulse.update(float(args[0][6:]))
+            if self.state != Controller.STATES.RUNNING:
+                await super().start(self.pulse)
+        else:
+            await super().start(*args)
 
-    async def _run(self, *args):
-        if isinstance(args[0], list):
-            for i in range(self.matrix.numPixels()):
-                self.matrix.setPixelColorRGB(i, *args[0])
-            self.matrix.show()
-        elif args[0] == 'colorscroll':
-            color = Color.from_hsv(h=1/3, s=1, v=1)
-            while self.state == Controller.STATES.RUNNING:
-                for i in range(self.matrix.numPixels()):
-                    self.matrix.setPixelColorRGB(
-                        i,
-                        int(color.rgb[0]*255),
-                        int(color.rgb[1]*255),
-                        int(color.rgb[2]*255))
-                self.matrix.show()
-
-                color += Hue(deg=3.6)
-                await asyncio.sleep(0.04)
-        elif args[0] == 'swipe_red':
-            pattern: list[tuple[int, int, int]] = [(255, 0, 0), (0, 0, 0)]
-
-            loop = cycle(pattern)
-
-            while self.state == Controller.STATES.RUNNING:
-                color = next(loop)
-                for led_index in range(self.matrix.numPixels()):
-                    self.matrix.setPixelColorRGB(led_index, *color)
-                self.matrix.show()
-
-                await asyncio.sleep(0.1)
+    def _start(self, pattern):
+        if isinstance(pattern, patterns.ProximityPulse):
+            self.live = pattern
+            self.animation = None
+            self.shown = None
+        else:
+            self.live = None
+            super()._start(pattern)
+
+    def _render(self, ticks: int):
+        if self.live is None:
+            super()._render(ticks)
+            return
+
+        level = self.live.step(self.compositor.interval)
+        if level != self.shown:
+            self.frame.frame(patterns.red_levels().frames(len(self.frame))[level])
+            self._show()
+            self.shown = level
+
+    def _show(self):
+        self.renderer.submit(self.frame.pixels, self.presented)
+
+    def _animation(self, pattern) -> Optional[patterns.Animation]:
+        if isinstance(pattern, list):
+            return patterns.solid(tuple(channel/255 for channel in pattern))
+        return patterns.animation(pattern)
+
+    def _output(self, animation: patterns.Animation, index: int):
+        self.frame.frame(animation.frames(len(self.frame))[index])
+        self._show()
 
     async def off(self):
         await self.stop()
-        for i in range(self.matrix.numPixels()):
-            self.matrix.setPixelColorRGB(i, 0, 0, 0)
+        self.frame.clear()
+        self._show()
 
-        self.matrix.show()
+    async def __aexit__(self, type, value, traceback):
+        await super().__aexit__(type, value, traceback)
+        await self.renderer.close()
 
 
 class SoundController(Controller):
-    def __init__(self):
-        super().__init__()
+    def __init__(self, compositor: Compositor):
+        super().__init__(compositor)
         pygame.mixer.init(buffer=1024)
+        self.filename: Optional[str] = None
 
-    async def _run(self, *args):
-        pygame.mixer.music.load(args[0])
-        pygame.mixer.music.play(loops=-1)
+    def _start(self, filename: str):
+        self.filename = filename
 
-        pattern = tuple(0.1*i for i in range(int(1/0.1+1)))
-        pattern += pattern[-2::-1]
-
-        volume_loop = cycle(pattern)
-
-        while self.state == Controller.STATES.RUNNING:
-            await asyncio.sleep(0.1)
+    def _render(self, ticks: int):
+        # Started on a tick, in phase with the LEDs
+        if self.filename is not None:
+            pygame.mixer.music.load(self.filename)
+            pygame.mixer.music.play(loops=-1)
+            self.filename = None
+            self.presented.set()
 
     async def stop(self):
+        self.filename = None
         pygame.mixer.music.stop()
         pygame.mixer.music.unload()
         await super().stop()
     off = stop
 
 
-async def button_led_control(led: RGBLED, queue: PriorityQueue[tuple[int, dict[str, str]]], exit: Event):
-    async def execute(timestamp: int, command: dict[str, str], controller: ButtonLEDController):
-        # if datetime.now() < timestamp:
-        #     await asyncio.sleep((timestamp-datetime.now()).total_seconds())
+async def button_led_control(led: RGBLED, queue: PriorityQueue[tuple[int, dict[str, str]]], exit: Event,
+                             clock: clocksync.ClockEstimator,
+                             tracer: tracing.Tracer,
+                             compositor: Compositor):
+    latest = 0
+
+    async def execute(sequence: int, command: dict[str, str], controller: ButtonLEDController):
+        nonlocal latest
+        dispatched = time.monotonic()
+        await clocksync.wait_until(clock, command.get('at'))
+        # A command sent after this one may have come due first, it wins
+        if sequence < latest:
+            return
+        latest = sequence
+        started = time.monotonic()
 
         if command['value'] == "START":
             await controller.start(command['pattern'])
@@ -189,68 +271,102 @@ async def button_led_control(led: RGBLED, queue: PriorityQueue[tuple[int, dict[s
         elif command['value'] == "OFF":
             await controller.off()
 
-    async with ButtonLEDController(led) as controller:
+        await tracer.rendered(command, dispatched, started, controller.presented)
+
+    async with ButtonLEDController(led, compositor) as controller:
         background_tasks = set()
+        sequence = 0
         while not exit.is_set():
             timestamp, command = await queue.get()
+            sequence += 1
 
             if command['type'] == 'DIE':
                 await controller.stop()
                 break
 
-            task = asyncio.create_task(execute(timestamp, command, controller))
+            task = asyncio.create_task(execute(sequence, command, controller))
 
             background_tasks.add(task)
 
             task.add_done_callback(background_tasks.discard)
 
 
-async def led_matrix_control(matrix: PixelStrip, queue: PriorityQueue[tuple[int, dict[str, str]]], exit: Event):
-    async def execute(timestamp: int, command: dict[str, str], controller: MatrixLEDController):
-        # if datetime.now() < timestamp:
-        #     await asyncio.sleep((timestamp-datetime.now()).total_seconds())
+async def led_matrix_control(matrix: PixelStrip, queue: PriorityQueue[tuple[int, dict[str, str]]], exit: Event,
+                             clock: clocksync.ClockEstimator,
+                             tracer: tracing.Tracer,
+                             compositor: Compositor):
+    latest = 0
+
+    async def execute(sequence: int, command: dict[str, str], controller: MatrixLEDController):
+        nonlocal latest
+        dispatched = time.monotonic()
+        await clocksync.wait_until(clock, command.get('at'))
+        # A command sent after this one may have come due first, it wins
+        if sequence < latest:
+            return
+        latest = sequence
+        started = time.monotonic()
 
         if command['value'] == "START":
             await controller.start(command['pattern'])
         elif command['value'] == "OFF":
             await controller.off()
 
-    async with MatrixLEDController(matrix) as controller:
+        await tracer.rendered(command, dispatched, started, controller.presented)
+
+    async with MatrixLEDController(matrix, compositor) as controller:
         background_tasks = set()
+        sequence = 0
         while not exit.is_set():
             timestamp, command = await queue.get()
+            sequence += 1
 
             if command['type'] == 'DIE':
                 await controller.stop()
                 break
 
-            task = asyncio.create_task(execute(timestamp, command, controller))
+            task = asyncio.create_task(execute(sequence, command, controller))
 
             background_tasks.add(task)
 
             task.add_done_callback(background_tasks.discard)
 
 
-async def sound_control(queue: PriorityQueue[tuple[int, dict[str, str]]], exit: Event):
-    async def execute(timestamp: int, command: dict[str, str], controller: SoundController):
-        # if datetime.now() < timestamp:
-        #     await asyncio.sleep((timestamp-datetime.now()).total_seconds())
+async def sound_control(queue: PriorityQueue[tuple[int, dict[str, str]]], exit: Event,
+                        clock: clocksync.ClockEstimator,
+                        tracer: tracing.Tracer,
+                        compositor: Compositor):
+    latest = 0
+
+    async def execute(sequence: int, command: dict[str, str], controller: SoundController):
+        nonlocal latest
+        dispatched = time.monotonic()
+        await clocksync.wait_until(clock, command.get('at'))
+        # A command sent after this one may have come due first, it wins
+        if sequence < latest:
+            return
+        latest = sequence
+        started = time.monotonic()
 
         if command['value'] == "START":
             await controller.start(command['filename'])
         elif command['value'] == "STOP":
             await controller.stop()
 
-    async with SoundController() as controller:
+        await tracer.rendered(command, dispatched, started, controller.presented)
+
+    async with SoundController(compositor) as controller:
         background_tasks = set()
+        sequence = 0
         while not exit.is_set():
             timestamp, command = await queue.get()
+            sequence += 1
 
             if command['type'] == 'DIE':
                 await controller.stop()
                 exit.set()
 
-            task = asyncio.create_task(execute(timestamp, command, controller))
+            task = asyncio.create_task(execute(sequence, command, controller))
 
             background_tasks.add(task)
 
@@ -262,8 +378,9 @@ def get_cpu_id():
         return unit_id.read()
 
 
-async def register(ws):
-    message = json.dumps({'type': "REGISTER", "id": get_cpu_id()}).encode()
+async def register(ws, room: str):
+    message = json.dumps({'type': "REGISTER", "id": get_cpu_id(),
+                          'features': protocol.FEATURES, 'room': room}).encode()
     await send_server(ws, message)
 
 
@@ -276,37 +393,54 @@ async def recv_server(socket: WebSocketClientProtocol,
                       exit: Event,
                       button_led_queue: PriorityQueue[tuple[int, dict[str, str]]],
                       matrix_queue: PriorityQueue[tuple[int, dict[str, str]]],
-                      sound_queue: PriorityQueue[tuple[int, dict[str, str]]]):
+                      sound_queue: PriorityQueue[tuple[int, dict[str, str]]],
+                      clock: clocksync.ClockEstimator):
     i = 0
     async for msg in socket:
+        received = time.time()
+        arrived = time.monotonic()
         if exit.is_set():
             break
 
-        message: dict[str, str] = json.loads(msg)
-        # timestamp = datetime.strptime(message['at'], "%Y-%m-%d %H:%M:%S.%f")
-
-        print(message)
-        if message['type'] == "BUTTON_LED":
-            await button_led_queue.put((i, message))
-        elif message['type'] == "MATRIX_LED":
-            await matrix_queue.put((i, message))
-        elif message['type'] == "SOUND":
-            await sound_queue.put((i, message))
-        elif message['type'] == "DIE":
-            exit.set()
-            await button_led_queue.put((i, message))
-            await matrix_queue.put((i, message))
-            await sound_queue.put((i, message))
-        i+=1
+        for message in protocol.decode_all(msg):
+            if 'trace' in message:
+                message['received'] = arrived
+            print(message)
+            if message['type'] == "CLOCK_PONG":
+                clocksync.on_pong(clock, message, received)
+            elif message['type'] == "BUTTON_LED":
+                button_led_queue.put_nowait((i, message))
+            elif message['type'] == "MATRIX_LED":
+                matrix_queue.put_nowait((i, message))
+            elif message['type'] == "SOUND":
+                sound_queue.put_nowait((i, message))
+            elif message['type'] == "DIE":
+                exit.set()
+                button_led_queue.put_nowait((i, message))
+                matrix_queue.put_nowait((i, message))
+                sound_queue.put_nowait((i, message))
+            i += 1
 
 
 async def send_server(socket: WebSocketClientProtocol, message: bytes):
     await socket.send(message)
 
 
-def button_pressed(ws: WebSocketClientProtocol, eventloop: asyncio.AbstractEventLoop):
-    message = json.dumps({'type': "BUTTON_PRESSED"}).encode()
-    asyncio.run_coroutine_threadsafe(send_server(ws, message), eventloop)
+async def send_pressed(socket: WebSocketClientProtocol, tracer: tracing.Tracer, edge: float):
+    await send_server(socket, json.dumps(tracer.pressed(edge)).encode())
+
+
+async def send_acknowledgements(socket: WebSocketClientProtocol, tracer: tracing.Tracer):
+    while True:
+        ack = await tracer.acks.get()
+        await send_server(socket, json.dumps(ack).encode())
+
+
+def button_pressed(ws: WebSocketClientProtocol, eventloop: asyncio.AbstractEventLoop,
+                   tracer: tracing.Tracer):
+    # Runs in the gpiozero thread, the edge is as close to the press as it gets
+    edge = time.monotonic()
+    asyncio.run_coroutine_threadsafe(send_pressed(ws, tracer, edge), eventloop)
 
 
 def button_released(ws: WebSocketClientProtocol, eventloop: asyncio.AbstractEventLoop):
@@ -322,26 +456,15 @@ def parse_arguments(args: list[str]):
                         help='The path to the CA certificate', required=True)
     parser.add_argument('-g', '--gamemaster-url',
                         action='append', required=True)
+    parser.add_argument('-r', '--room', default='default',
+                        help='The game room this unit plays in')
+    parser.add_argument('--gamemaster-cache', metavar='path',
+                        default=discovery.DEFAULT_CACHE,
+                        help='Where the last gamemaster found is kept')
 
     return parser.parse_args(args)
 
 
-def discover_gamemaster(gamemaster_urls: list[str], ca_certificate: str):
-    gamemaster = None
-    for url in gamemaster_urls:
-        try:
-            response = requests.get(
-                f"https://{url}:8002/alive",
-                verify=ca_certificate,
-                timeout=1)
-
-            gamemaster = response.content.decode().strip()
-        except (requests.ReadTimeout, requests.TooManyRedirects, requests.ConnectionError):
-            pass
-
-    return gamemaster
-
-
 async def main(args: list[str]):
     ''' The main function for the unit '''
 
@@ -360,51 +483,86 @@ async def main(args: list[str]):
                                      dict[str, str]]] = asyncio.PriorityQueue()
 
     exit_event = asyncio.Event()
+    clock = clocksync.ClockEstimator()
+    tracer = tracing.Tracer()
+    compositor = Compositor()
 
     led_matrix.begin()
+    patterns.preload(led_matrix.numPixels())
 
     loop = asyncio.get_event_loop()
 
-    ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    ssl_context = tlssession.ResumingSSLContext(ssl.PROTOCOL_TLS_CLIENT)
     ssl_context.load_verify_locations(options.ca_certificate)
 
+    compositor_task = asyncio.create_task(compositor.run())
+    report_task = asyncio.create_task(compositor.report())
     button_led_task = asyncio.create_task(
         button_led_control(
             button_led,
             button_led_queue,
-            exit_event))
+            exit_event,
+            clock,
+            tracer,
+            compositor))
     led_matrix_task = asyncio.create_task(
         led_matrix_control(
             led_matrix,
             led_matrix_queue,
-            exit_event))
+            exit_event,
+            clock,
+            tracer,
+            compositor))
     sound_task = asyncio.create_task(
         sound_control(
             sound_queue,
-            exit_event))
+            exit_event,
+            clock,
+            tracer,
+            compositor))
 
+    backoff = discovery.Backoff(cap=RECHECK_INTERVAL)
     while not exit_event.is_set():
-        gamemaster_url = discover_gamemaster(
-            options.gamemaster_url, options.ca_certificate)
+        cached = discovery.load_cached(options.gamemaster_cache)
+        gamemaster_url = cached or await discovery.discover(options.gamemaster_url, ssl_context,
+                                                            options.gamemaster_cache)
         if gamemaster_url:
-            async with connect(f"wss://{gamemaster_url}:8001", ssl=ssl_context) as socket:
-                loop.add_signal_handler(
-                    signal.SIGTERM, loop.create_task, socket.close())
-                button.when_pressed = lambda: button_pressed(socket, loop)
-                button.when_released = lambda: button_released(
-                    socket, loop)
-
-                await register(socket)
-                try:
-                    await recv_server(socket,
-                                      exit_event,
-                                      button_led_queue,
-                                      led_matrix_queue,
-                                      sound_queue)
-                except ConnectionClosedError:
-                    pass
-                else:
-                    await unregister(socket)
+            try:
+                open_timeout = discovery.CACHED_CONNECT_TIMEOUT if cached else discovery.CONNECT_TIMEOUT
+                async with connect(f"wss://{gamemaster_url}:8002/units", ssl=ssl_context,
+                                   open_timeout=open_timeout) as socket:
+                    loop.add_signal_handler(
+                        signal.SIGTERM, loop.create_task, socket.close())
+                    button.when_pressed = lambda: button_pressed(socket, loop, tracer)
+                    button.when_released = lambda: button_released(
+                        socket, loop)
+
+                    await register(socket, options.room)
+                    sync_task = asyncio.create_task(
+                        clocksync.synchronize(socket, clock))
+                    ack_task = asyncio.create_task(
+                        send_acknowledgements(socket, tracer))
+                    try:
+                        await recv_server(socket,
+                                          exit_event,
+                                          button_led_queue,
+                                          led_matrix_queue,
+                                          sound_queue,
+                                          clock)
+                    except ConnectionClosedError:
+                        pass
+                    else:
+                        await unregister(socket)
+                    finally:
+                        sync_task.cancel()
+                        ack_task.cancel()
+            except (OSError, asyncio.TimeoutError, InvalidHandshake):
+                discovery.forget_cached(options.gamemaster_cache)
+                # A stale cache falls back to discovery right away
+                if not cached:
+                    await asyncio.sleep(backoff.next())
+            else:
+                backoff.reset()
         else:
             start_blink = {
                 'type': 'BUTTON_LED', 'value': 'START', 'pattern': "flash_red"}
@@ -416,7 +574,7 @@ async def main(args: list[str]):
             await led_matrix_queue.put((i, stop_matrix))
             await sound_queue.put((i, stop_sound))
 
-            await asyncio.sleep(RECHECK_INTERVAL)
+            await asyncio.sleep(backoff.next())
 
             stop_blink = {'type': 'BUTTON_LED', 'value': 'STOP'}
             